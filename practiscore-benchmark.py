@@ -0,0 +1,228 @@
+#!/usr/bin/env python3
+import argparse
+import copy
+import datetime
+import importlib.util
+import json
+import os
+import random
+import sys
+import timeit
+import uuid
+
+RESULTS = {}
+
+def load_leaderboard(engine=None):
+	# the leaderboard module reads config/ relative to the working directory
+	directory = os.path.dirname(os.path.abspath(__file__))
+	os.chdir(directory)
+	spec = importlib.util.spec_from_file_location('leaderboard', os.path.join(directory, 'practiscore-leaderboard.py'))
+	leaderboard = importlib.util.module_from_spec(spec)
+	sys.modules['leaderboard'] = leaderboard
+	spec.loader.exec_module(leaderboard)
+	leaderboard.kiosk = leaderboard.Kiosk()
+	leaderboard.kiosk.config.data['engine'] = engine
+	return leaderboard
+
+def stamp(seconds):
+	return (datetime.datetime(2026, 5, 1, 9) + datetime.timedelta(seconds=seconds)).strftime('%Y-%m-%d %H:%M:%S.%f')[:-3]
+
+def new_uuid(r):
+	return str(uuid.UUID(int=r.getrandbits(128)))
+
+def ipsc_match(shooters=300, stages=12, targets=8, seed=1):
+	r = random.Random(seed)
+	match_id = new_uuid(r)
+	match_pfs = [{'name': 'Minor', 'A': 5, 'B': 3, 'C': 3, 'D': 1, 'M': 10, 'NS': 10}, {'name': 'Major', 'A': 5, 'B': 4, 'C': 4, 'D': 2, 'M': 10, 'NS': 10}]
+	match_shooters = [{'sh_uid': new_uuid(r), 'sh_fn': f'First{i}', 'sh_ln': f'Last{i}', 'sh_dvp': r.choice(['Production', 'Open', 'Standard', 'Classic', 'Production Optics']), 'sh_pf': r.choice(['Minor', 'Major']), 'sh_del': False, 'sh_dq': r.random() < 0.01, 'sh_mod': stamp(i)} for i in range(shooters)]
+	match_stages = [{'stage_uuid': new_uuid(r), 'stage_number': i+1, 'stage_name': f'Stage {i+1}', 'stage_modifieddate': stamp(i), 'stage_poppers': r.randint(0, 4), 'stage_targets': [{'target_reqshots': 2} for _ in range(targets)]} for i in range(stages)]
+	match_scores = []
+	for stage in match_stages:
+		stage_stagescores = []
+		for shooter in match_shooters:
+			if r.random() < 0.05:
+				continue
+			ts = []
+			for _ in range(targets):
+				hits = [0]*7
+				for _ in range(2):
+					hits[r.choice([0, 0, 0, 0, 1, 2, 3, 5])] += 1
+				ts.append(sum(count << 4*i for i, count in enumerate(hits)))
+			stage_stagescores.append({'shtr': shooter['sh_uid'], 'mod': stamp(r.randint(0, 36000)), 'ts': ts, 'str': [round(r.uniform(8, 60), 2)], 'poph': r.randint(0, stage['stage_poppers']), 'popm': 0, 'popns': 0, 'proc_cnts': [{'0': 1}] if r.random() < 0.05 else [], 'dnf': r.random() < 0.005, 'rawpts': 0})
+		match_scores.append({'stage_uuid': stage['stage_uuid'], 'stage_stagescores': stage_stagescores})
+	match_def = {'match_id': match_id, 'match_subtype': 'ipsc', 'match_name': 'Benchmark IPSC', 'match_modifieddate': stamp(0), 'match_pfs': match_pfs, 'match_shooters': match_shooters, 'match_stages': match_stages}
+	return match_def, {'match_id': match_id, 'match_scores': match_scores}
+
+def scsa_match(shooters=120, stages=8, targets=5, seed=2):
+	r = random.Random(seed)
+	match_id = new_uuid(r)
+	match_shooters = [{'sh_uid': new_uuid(r), 'sh_fn': f'First{i}', 'sh_ln': f'Last{i}', 'sh_dvp': r.choice(['Rimfire Open', 'Rimfire Iron', 'Carry Optics', 'Production', 'Limited']), 'sh_del': False, 'sh_dq': r.random() < 0.01, 'sh_mod': stamp(i)} for i in range(shooters)]
+	match_stages = [{'stage_uuid': new_uuid(r), 'stage_number': i+1, 'stage_name': f'Stage {i+1}', 'stage_modifieddate': stamp(i)} for i in range(stages)]
+	match_scores = []
+	for stage in match_stages:
+		stage_stagescores = []
+		for shooter in match_shooters:
+			if r.random() < 0.05:
+				continue
+			strings = [round(r.uniform(2, 9), 2) for _ in range(targets)]
+			penalties = [[int(r.random() < 0.05), 0, int(r.random() < 0.01), 0] for _ in range(targets)]
+			stage_stagescores.append({'shtr': shooter['sh_uid'], 'mod': stamp(r.randint(0, 36000)), 'str': strings, 'penss': penalties, 'dnf': False})
+		match_scores.append({'stage_uuid': stage['stage_uuid'], 'stage_stagescores': stage_stagescores})
+	match_def = {'match_id': match_id, 'match_subtype': 'scsa', 'match_name': 'Benchmark SCSA', 'match_modifieddate': stamp(0), 'match_shooters': match_shooters, 'match_stages': match_stages}
+	return match_def, {'match_id': match_id, 'match_scores': match_scores}
+
+GENERATORS = {'ipsc': ipsc_match, 'scsa': scsa_match}
+
+def device_payloads(match_def, match_scores, devices):
+	# every device carries the full match_def and scores for its share of the stages
+	return [(match_def, {'match_id': match_scores['match_id'], 'match_scores': match_scores['match_scores'][i::devices]}) for i in range(devices)]
+
+def touch(match_def, match_scores, seconds=1):
+	# a copy of the match with every modification stamp moved forward
+	match_def, match_scores = copy.deepcopy(match_def), copy.deepcopy(match_scores)
+	for shooter in match_def['match_shooters']:
+		shooter['sh_mod'] = stamp(seconds + 36000)
+	for stage in match_scores['match_scores']:
+		for stage_stagescore in stage['stage_stagescores']:
+			stage_stagescore['mod'] = stamp(seconds + 36000)
+	return match_def, match_scores
+
+def touch_one(match_scores, seconds=1):
+	match_scores = copy.deepcopy(match_scores)
+	stage_stagescore = match_scores['match_scores'][0]['stage_stagescores'][0]
+	stage_stagescore['mod'] = stamp(seconds + 36000)
+	stage_stagescore['str'] = [x + 0.5 for x in stage_stagescore['str']]
+	return match_scores
+
+def bench(name, function, repeat, setup=None):
+	times = []
+	for _ in range(repeat):
+		argument = setup() if setup else None
+		start = timeit.default_timer()
+		function(argument)
+		times.append(timeit.default_timer() - start)
+	RESULTS[name] = {'best': min(times), 'median': sorted(times)[len(times)//2]}
+	print(f'{name:<32} best {min(times)*1000:10.2f} ms  median {RESULTS[name]["median"]*1000:10.2f} ms')
+	return min(times)
+
+def ingest(leaderboard, payloads):
+	registry = leaderboard.MatchRegistry()
+	for i, (match_def, match_scores) in enumerate(payloads):
+		registry.update(f'device{i}', copy.deepcopy(match_def), copy.deepcopy(match_scores))
+	return registry
+
+def bench_stamps(leaderboard, sub_type, payloads, repeat):
+	pairs = [(score['mod'], stamp(36000)) for match_def, match_scores in payloads for stage in match_scores['match_scores'] for score in stage['stage_stagescores']]
+	pairs += [(shooter['sh_mod'], stamp(36000)) for shooter in payloads[0][0]['match_shooters']]
+	def strptime(_):
+		for new, old in pairs:
+			leaderboard.str_to_datetime(new) > leaderboard.str_to_datetime(old)
+	def stamps(_):
+		stamps = [(new, old, leaderboard.date_stamp(old)) for new, old in pairs]
+		for new, old, old_stamp in stamps:
+			new != old and leaderboard.date_stamp(new) > old_stamp
+	before = bench(f'{sub_type} compare strptime', strptime, repeat)
+	after = bench(f'{sub_type} compare date_stamp', stamps, repeat)
+	print(f'{"speedup":<32} {before/after:.1f}x')
+
+def bench_decode(leaderboard, sub_type, payloads, repeat):
+	raw = [(json.dumps(match_def).encode(), json.dumps(match_scores).encode()) for match_def, match_scores in payloads]
+	bench(f'{sub_type} decode', lambda _: [(json.loads(match_def), json.loads(match_scores)) for match_def, match_scores in raw], repeat)
+
+def bench_ingest(leaderboard, sub_type, payloads, repeat):
+	def update(payloads):
+		registry = leaderboard.MatchRegistry()
+		for i, (match_def, match_scores) in enumerate(payloads):
+			registry.update(f'device{i}', match_def, match_scores)
+	bench(f'{sub_type} ingest', update, repeat, lambda: copy.deepcopy(payloads))
+
+def bench_merge(leaderboard, sub_type, payloads, repeat):
+	touched = [touch(match_def, match_scores) for match_def, match_scores in payloads]
+	def merge(payloads):
+		def update(registry):
+			for i, (match_def, match_scores) in enumerate(payloads):
+				registry.update(f'device{i}', match_def, match_scores)
+		return update
+	bench(f'{sub_type} merge unchanged', merge(payloads), repeat, lambda: ingest(leaderboard, payloads))
+	bench(f'{sub_type} merge all modified', merge(touched), repeat, lambda: ingest(leaderboard, payloads))
+
+def bench_scoring(leaderboard, sub_type, payloads, repeat):
+	match_def, match_scores = payloads[0]
+	touched_scores = touch_one(match_scores)
+	def full(registry):
+		for match in registry.matches.values():
+			match.post_process()
+	def one_change(registry):
+		registry.update('device0', match_def, touched_scores)
+		full(registry)
+	def scored():
+		registry = ingest(leaderboard, payloads)
+		full(registry)
+		return registry
+	bench(f'{sub_type} scoring full', full, repeat, lambda: ingest(leaderboard, payloads))
+	bench(f'{sub_type} scoring one change', one_change, repeat, scored)
+
+def bench_data(leaderboard, sub_type, payloads, repeat):
+	kiosk = leaderboard.kiosk
+	def scored():
+		kiosk.registry = ingest(leaderboard, payloads)
+		kiosk.registry.data()
+	bench(f'{sub_type} Kiosk.data', lambda _: kiosk.data(), repeat, scored)
+
+def bench_render(leaderboard, sub_type, payloads, repeat):
+	kiosk = leaderboard.kiosk
+	kiosk.registry = ingest(leaderboard, payloads)
+	data = kiosk.data()
+	with leaderboard.app.test_request_context('/'):
+		bench(f'{sub_type} render matches.html', lambda _: leaderboard.render_template('matches.html', data=data), repeat)
+
+BENCHMARKS = {'stamps': bench_stamps, 'decode': bench_decode, 'ingest': bench_ingest, 'merge': bench_merge, 'scoring': bench_scoring, 'data': bench_data, 'render': bench_render}
+
+def record(path, version, label, parameters):
+	# append this run and report the change from the last run with the same parameters
+	previous = None
+	if os.path.exists(path):
+		with open(path) as f:
+			for line in f:
+				run = json.loads(line)
+				if run['parameters'] == parameters:
+					previous = run
+	if previous:
+		print(f'compared with {previous["version"]} {previous["label"] or ""} at {previous["time"]}')
+		for name in RESULTS:
+			if name in previous['results']:
+				change = RESULTS[name]['best']/previous['results'][name]['best'] - 1
+				print(f'{name:<32} {change*100:+7.1f} %')
+	with open(path, 'a') as f:
+		f.write(json.dumps({'time': datetime.datetime.now().isoformat(timespec='seconds'), 'version': version, 'label': label, 'parameters': parameters, 'results': RESULTS}) + '\n')
+	print(f'results appended to {path}')
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='Time the leaderboard hot paths on synthetic matches.')
+	parser.add_argument('benchmarks', nargs='*', help=f'any of {", ".join(BENCHMARKS)} (default all)')
+	parser.add_argument('--sub-types', default='ipsc,scsa', help='comma separated match types (default ipsc,scsa)')
+	parser.add_argument('--shooters', type=int, default=300)
+	parser.add_argument('--stages', type=int, default=12)
+	parser.add_argument('--targets', type=int, default=8)
+	parser.add_argument('--devices', type=int, default=4, help='tablets the stages are split across')
+	parser.add_argument('--repeat', type=int, default=5)
+	parser.add_argument('--engine', choices=['numpy'], help='scoring engine passed through the config')
+	parser.add_argument('--output', default='benchmark-results.jsonl', help='results file, appended to (default benchmark-results.jsonl)')
+	parser.add_argument('--label', help='free text stored with the results')
+	args = parser.parse_args()
+	for name in args.benchmarks:
+		if name not in BENCHMARKS:
+			parser.error(f'unknown benchmark {name}')
+	sub_types = args.sub_types.split(',')
+	for sub_type in sub_types:
+		if sub_type not in GENERATORS:
+			parser.error(f'unknown match type {sub_type}')
+	output = os.path.abspath(args.output)
+	leaderboard = load_leaderboard(args.engine)
+	for sub_type in sub_types:
+		match_def, match_scores = GENERATORS[sub_type](args.shooters, args.stages, args.targets)
+		payloads = device_payloads(match_def, match_scores, args.devices)
+		for name in args.benchmarks or BENCHMARKS:
+			BENCHMARKS[name](leaderboard, sub_type, payloads, args.repeat)
+	parameters = {name: getattr(args, name) for name in ('benchmarks', 'sub_types', 'shooters', 'stages', 'targets', 'devices', 'engine')}
+	record(output, leaderboard.__version__, args.label, parameters)
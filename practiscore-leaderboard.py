@@ -1,30 +1,92 @@
 #!.venv/bin/python3
 
+import time
+STARTED = time.perf_counter()
 import flask
 import datetime
-import asyncio
 import os
+import sys
+import signal
 import json
 import struct
-import time
 import zlib
+import hashlib
+import tempfile
 import fcntl
 import ipaddress
 import socket
-from apscheduler.schedulers.background import BackgroundScheduler
+import threading
+import random
+import collections
+import contextlib
+import bisect
+import array
+import pickle
+import multiprocessing
+import multiprocessing.connection
+
+class Startup:
+	# time spent in each step from the first import until the server listens
+	def __init__(self, started):
+		self.started = started
+		self.last = started
+		self.steps = []
+
+	def mark(self, step):
+		now = time.perf_counter()
+		self.steps.append((step, now - self.last))
+		self.last = now
+
+	def report(self, name='startup'):
+		print(f'{name}: ' + ', '.join(f'{step} {seconds*1000:.0f} ms' for step, seconds in self.steps) + f', total {(self.last - self.started)*1000:.0f} ms')
+		for step, seconds in self.steps:
+			metrics.set('practiscore_startup_seconds', seconds, (('step', step),))
+
+startup = Startup(STARTED)
+startup.mark('imports')
+
+# numpy and asyncio are imported when first needed: numpy only for the
+# numpy engine and asyncio once polling starts
+numpy = None
+
+def load_numpy():
+	global numpy
+	if numpy is None:
+		try:
+			import numpy
+		except ImportError:
+			numpy = False
+	return numpy
 
+def load_asyncio():
+	global asyncio
+	import asyncio
 
 app = flask.Flask(__name__)
 
+EVENTS_KEEPALIVE = 15
+EVENTS_RETRY = 5
+KIOSK_PAGE_TIME = 10
+
 __version__ = '1.1.0-alpha'
 print(f'practiscore-leaderboard-{__version__}')
 
-def is_modified(modified_date_1, modified_date_2):
-	if modified_date_1 == modified_date_2:
+def is_modified(modified_date, entity):
+	if modified_date == entity.modified_date:
 		return False
-	date_1 = str_to_datetime(modified_date_1)
-	date_2 = str_to_datetime(modified_date_2)
-	return date_1 > date_2
+	return date_stamp(modified_date) > entity.modified_stamp
+
+def date_stamp(string):
+	# 'YYYY-MM-DD HH:MM:SS[.ffffff]' as a sortable YYYYMMDDHHMMSSffffff integer
+	if string is None:
+		return 0
+	date, _, fraction = string.partition('.')
+	if len(date) == 19 and len(fraction) <= 6 and date[4] == '-' and date[10] == ' ':
+		try:
+			return int(date[0:4]+date[5:7]+date[8:10]+date[11:13]+date[14:16]+date[17:19]+fraction.ljust(6, '0'))
+		except ValueError:
+			pass
+	return int(str_to_datetime(string).strftime('%Y%m%d%H%M%S%f'))
 
 def str_to_datetime(string):
 	try:
@@ -35,8 +97,34 @@ def str_to_datetime(string):
 def the_time():
 	return datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
 
-def render_template(template, data=None):
-	return flask.render_template(template, data=data, version=__version__, time=the_time())
+def parse_at(string):
+	# 'YYYY-MM-DD HH:MM[:SS]', or 'HH:MM[:SS]' today, as a timestamp
+	for layout in ('%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M', '%H:%M:%S', '%H:%M'):
+		try:
+			at = datetime.datetime.strptime(string, layout)
+		except (TypeError, ValueError):
+			continue
+		if '-' not in layout:
+			at = datetime.datetime.combine(datetime.date.today(), at.time())
+		return at.timestamp()
+	return None
+
+def render_template(template, data=None, version=None):
+	# version is the one the page is cached under, so the reload script compares against the body it came with
+	return flask.render_template(template, data=data, version=__version__, time=the_time(), data_version=kiosk.registry.etag(version))
+
+def cached_response(view, build, mimetype='text/html', version=None, variant=None):
+	# variant tells apart the pages one URL serves in turn
+	registry = kiosk.registry
+	if version is None:
+		version = registry.version
+	response = flask.Response(kiosk.render_cache.get(view, version, build), mimetype=mimetype)
+	# tagged with the version the body was cached under, which a merge may since have moved past
+	etag = registry.etag(version)
+	response.set_etag(etag if variant is None else f'{etag}-{variant}')
+	response.last_modified = registry.modified
+	response.cache_control.no_cache = True
+	return response.make_conditional(flask.request)
 
 
 def get_subnet(ifname):
@@ -50,16 +138,51 @@ def get_interface(if_name):
 	subnetmask = socket.inet_ntoa(fcntl.ioctl(s.fileno(), 0x891b, struct.pack('256s',if_name_bytes))[20:24])
 	return ipaddress.ip_interface((address, subnetmask))
 
-for ifname in socket.if_nameindex():
+def print_interfaces():
+	for ifname in socket.if_nameindex():
+		try:
+			print(get_interface(ifname[1]))
+		except:
+			pass
+
+def precompile_templates(directory):
+	# compiled templates are kept on disk across boots and loaded ahead of the first request
+	import jinja2
+	start = time.perf_counter()
 	try:
-		print(get_interface(ifname[1]))
-	except:
-		pass
+		os.makedirs(directory, exist_ok=True)
+		app.jinja_env.bytecode_cache = jinja2.FileSystemBytecodeCache(directory)
+	except OSError as e:
+		print(f'{directory}: {e}')
+	templates = app.jinja_env.list_templates()
+	for template in templates:
+		app.jinja_env.get_template(template)
+	metrics.set('practiscore_startup_seconds', time.perf_counter() - start, (('step', 'templates'),))
+	print(f'templates: {len(templates)} loaded in {(time.perf_counter() - start)*1000:.0f} ms')
 
 @app.get('/')
 def get_index():
-	data = kiosk.data()
-	return render_template('matches.html', data=data)
+	version = kiosk.registry.version
+	return profiler.call('render', cached_response, 'matches', lambda: render_template('matches.html', data=kiosk.data(), version=version), 'text/html', version)
+
+@app.get('/events')
+def get_events():
+	registry = kiosk.registry
+	version = registry.parse_etag(flask.request.headers.get('Last-Event-ID', flask.request.args.get('version')))
+	def stream(version):
+		yield f'retry: {EVENTS_RETRY*1000}\n\n'
+		while True:
+			event = registry.wait(version, EVENTS_KEEPALIVE)
+			if event is None:
+				yield ': keepalive\n\n'
+			else:
+				version = registry.parse_etag(event['version'])
+				yield f'id: {event["version"]}\nevent: version\ndata: {json.dumps(event)}\n\n'
+	return flask.Response(stream(-1 if version is None else version), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.get('/metrics')
+def get_metrics():
+	return flask.Response(kiosk.metrics(), mimetype='text/plain; version=0.0.4')
 
 @app.get('/scan')
 def get_scan():
@@ -67,8 +190,48 @@ def get_scan():
 
 @app.get('/kiosk/<id>')
 def get_kiosk(id):
-	data = kiosk.data()
-	return render_template('matches.html', data=data)
+	profile = kiosk.kiosks.get(id)
+	if not profile:
+		return get_index()
+	version = kiosk.registry.version
+	pages = kiosk.render_cache.get(f'kiosk/{id}', version, lambda: kiosk_pages(kiosk.registry.data(), profile))
+	page = flask.request.args.get('page', type=int)
+	if page is None:
+		page = int(time.time() // kiosk_page_time(profile)) % len(pages)
+	elif 1 <= page <= len(pages):
+		page -= 1
+	else:
+		return {'error': 404}, 404
+	return profiler.call('render', cached_response, f'kiosk/{id}/{page}', lambda: render_template('matches.html', data={'matches': [pages[page]]}, version=version), 'text/html', version, page)
+
+@app.get('/kiosk/<id>/profile')
+def get_kiosk_profile(id):
+	# the display page turns on this interval, so it stays in step with the pages served above
+	profile = kiosk.kiosks.get(id)
+	if not profile:
+		return {'error': 404}, 404
+	return {'page_time': kiosk_page_time(profile)}
+
+@app.get('/history')
+def get_history():
+	at = parse_at(flask.request.args.get('at'))
+	if at is None:
+		return {'error': 400}, 400
+	registry = kiosk.history(at)
+	if registry is None:
+		return {'error': 404}, 404
+	# no data_version: a past leaderboard has nothing to reload for
+	return flask.render_template('matches.html', data={'matches': registry.data(), 'devices': kiosk.device_data()}, version=__version__, time=datetime.datetime.fromtimestamp(at).strftime('%Y-%m-%d %H:%M:%S'), data_version=None)
+
+@app.get('/json/history')
+def get_json_history():
+	at = parse_at(flask.request.args.get('at'))
+	if at is None:
+		return {'error': 400}, 400
+	registry = kiosk.history(at)
+	if registry is None:
+		return {'error': 404}, 404
+	return flask.Response(flask.json.dumps(registry.data()), mimetype='application/json')
 
 @app.get('/update')
 def get_update():
@@ -82,22 +245,39 @@ def get_device():
 @app.post('/save/device/<id>')
 def post_save_device_id(id):
 	if id in kiosk.devices:
-		kiosk.devices[id].save()
-		return {'match_def': kiosk.devices[id].match_def, 'match_scores': kiosk.devices[id].match_scores}
+		return kiosk.save_device(id)
 	else:
 		return {'error', 404}, 404
 
 @app.get('/json/device')
 def get_json_device():
-	return [kiosk.devices[id].data() for id in kiosk.devices]
+	return kiosk.device_data()
 
 @app.get('/json/device/<id>')
 def get_json_device_id(id):
 	if id in kiosk.devices:
-		return kiosk.devices[id].data() | { 'match_def': kiosk.devices[id].match_def, 'match_scores': kiosk.devices[id].match_scores }
+		# not cached by registry version: payloads and poll counters change without a merge
+		return flask.Response(flask.json.dumps(kiosk.device_payload(id)), mimetype='application/json')
 	else:
 		return {'error', 404}, 404
 
+@app.get('/json/match/<match_id>')
+def get_json_match_id(match_id):
+	data = kiosk.registry.delta(match_id, flask.request.args.get('since'))
+	if data is None:
+		return {'error': 404}, 404
+	return flask.Response(data, mimetype='application/json')
+
+@app.get('/json/match/<match_id>/ranking')
+def get_json_match_id_ranking(match_id):
+	count = flask.request.args.get('count', type=int)
+	page = flask.request.args.get('page', 1, type=int)
+	start = (page-1)*count if count and page > 0 else 0
+	data = kiosk.registry.ranking(match_id, flask.request.args.get('division'), start, count, flask.request.args.get('stage'))
+	if data is None:
+		return {'error': 404}, 404
+	return data
+
 @app.get('/auth')
 def get_auth():
 	return render_template('auth.html')
@@ -110,8 +290,19 @@ def get_admin():
 def post_admin():
 	if not flask.request.form.get('auth'):
 		return flask.redirect('/auth')
+	if flask.request.form.get('action') == 'profile':
+		target = flask.request.form.get('target')
+		count = flask.request.form.get('count', 1, type=int)
+		if target in Profiler.TARGETS and count > 0:
+			kiosk.profile(target, count)
 	files = [ file for file in os.listdir('config') if os.path.isfile(os.path.join('config/', file))]
-	return render_template('admin.html', data=files)
+	return render_template('admin.html', data={'files': files, 'profiles': profiler.files(), 'armed': kiosk.profiling(), 'targets': Profiler.TARGETS, 'auth': flask.request.form.get('auth')})
+
+@app.post('/admin/profile/<name>')
+def post_admin_profile(name):
+	if not flask.request.form.get('auth'):
+		return flask.redirect('/auth')
+	return flask.send_from_directory(profiler.directory, name, as_attachment=True)
 
 @app.post('/shutdown')
 def post_shutdown():
@@ -144,6 +335,208 @@ class Config:
 		else:
 			return None
 
+def write_atomic(path, data):
+	fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path) or '.', prefix=f'.{os.path.basename(path)}.', suffix='.tmp')
+	try:
+		with os.fdopen(fd, 'wb') as f:
+			f.write(data)
+			f.flush()
+			os.fsync(f.fileno())
+		os.replace(temp_path, path)
+	except BaseException:
+		os.unlink(temp_path)
+		raise
+
+class Writer:
+	DEFAULT_DELAY = 1
+
+	def __init__(self, delay=DEFAULT_DELAY):
+		self.delay = delay
+		self.pending = {}
+		self.condition = threading.Condition()
+		self.thread = None
+
+	def write(self, path, build):
+		with self.condition:
+			self.pending[path] = build
+			if not self.thread:
+				self.thread = threading.Thread(target=self.run, name='writer', daemon=True)
+				self.thread.start()
+			self.condition.notify()
+
+	def run(self):
+		while True:
+			with self.condition:
+				while not self.pending:
+					self.condition.wait()
+			# let a burst of saves to the same path collapse into one write
+			time.sleep(self.delay)
+			with self.condition:
+				pending, self.pending = self.pending, {}
+			for path in pending:
+				try:
+					data = pending[path]()
+					if data is not None:
+						write_atomic(path, data)
+				except OSError as e:
+					print(f'{path}: {e}')
+
+class RenderCache:
+	def __init__(self):
+		self.views = {}
+		self.lock = threading.Lock()
+
+	def get(self, view, version, build):
+		labels = (('view', view),)
+		with self.lock:
+			if view not in self.views or self.views[view][0] != version:
+				metrics.inc('practiscore_render_cache_total', labels + (('result', 'miss'),))
+				with metrics.timer('practiscore_render_seconds', labels):
+					self.views[view] = (version, build())
+			else:
+				metrics.inc('practiscore_render_cache_total', labels + (('result', 'hit'),))
+			return self.views[view][1]
+
+class Metrics:
+	# counters, gauges and histograms in the Prometheus text format; labels are
+	# tuples of (name, value) pairs
+	BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+	FAMILIES = {
+		'practiscore_polls_total': ('counter', 'Device polls by result.'),
+		'practiscore_poll_seconds': ('histogram', 'Time to fetch a payload from a device.'),
+		'practiscore_received_bytes_total': ('counter', 'Payload bytes received from a device.'),
+		'practiscore_connections_total': ('counter', 'Device connections by whether they were opened or reused.'),
+		'practiscore_device_last_success_timestamp_seconds': ('gauge', 'Time of the last successful poll of a device.'),
+		'practiscore_payloads_total': ('counter', 'Received payloads by whether they changed.'),
+		'practiscore_decode_seconds': ('histogram', 'Time to decompress and parse a payload.'),
+		'practiscore_merge_seconds': ('histogram', 'Time to merge a device payload into its match.'),
+		'practiscore_post_process_seconds': ('histogram', 'Time to score a match after a merge.'),
+		'practiscore_render_seconds': ('histogram', 'Time to render a view.'),
+		'practiscore_render_cache_total': ('counter', 'Render cache lookups by result.'),
+		'practiscore_startup_seconds': ('gauge', 'Time spent in each startup step.'),
+		'practiscore_journal_records_total': ('counter', 'Entity change records appended to the journal.'),
+		'practiscore_journal_bytes_total': ('counter', 'Bytes appended to the journal.'),
+	}
+
+	def __init__(self):
+		self.values = {}
+		self.lock = threading.Lock()
+
+	def inc(self, name, labels=(), value=1):
+		with self.lock:
+			self.values[name, labels] = self.values.get((name, labels), 0) + value
+
+	def set(self, name, value, labels=()):
+		with self.lock:
+			self.values[name, labels] = value
+
+	def observe(self, name, value, labels=()):
+		with self.lock:
+			if (name, labels) not in self.values:
+				self.values[name, labels] = [0]*len(self.BUCKETS) + [0, 0]
+			histogram = self.values[name, labels]
+			for i in range(bisect.bisect_left(self.BUCKETS, value), len(self.BUCKETS)):
+				histogram[i] += 1
+			histogram[-2] += 1
+			histogram[-1] += value
+
+	@contextlib.contextmanager
+	def timer(self, name, labels=()):
+		start = time.perf_counter()
+		try:
+			yield
+		finally:
+			self.observe(name, time.perf_counter() - start, labels)
+
+	def format_labels(self, labels):
+		if not labels:
+			return ''
+		escape = lambda value: str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+		return '{' + ','.join(f'{name}="{escape(value)}"' for name, value in labels) + '}'
+
+	def render(self, extra=()):
+		with self.lock:
+			values = {key: list(value) if isinstance(value, list) else value for key, value in self.values.items()}
+		lines = []
+		for family, (kind, help) in self.FAMILIES.items():
+			series = sorted(((extra + labels, value) for (name, labels), value in values.items() if name == family), key=lambda item: str(item[0]))
+			if not series:
+				continue
+			lines += [f'# HELP {family} {help}', f'# TYPE {family} {kind}']
+			for labels, value in series:
+				if kind == 'histogram':
+					lines += [f'{family}_bucket{self.format_labels(labels + (("le", le),))} {count}' for le, count in zip(self.BUCKETS + ('+Inf',), value[:-2] + [value[-2]])]
+					lines += [f'{family}_sum{self.format_labels(labels)} {value[-1]}', f'{family}_count{self.format_labels(labels)} {value[-2]}']
+				else:
+					lines.append(f'{family}{self.format_labels(labels)} {value}')
+		return '\n'.join(lines) + '\n'
+
+metrics = Metrics()
+
+class Profiler:
+	# cProfile of the next N calls of a target; while nothing is armed the
+	# call sites only look up an empty dict
+	TARGETS = ('render', 'poll')
+	DEFAULT_DIRECTORY = os.path.join(tempfile.gettempdir(), 'practiscore-leaderboard-profiles')
+
+	def __init__(self):
+		self.directory = self.DEFAULT_DIRECTORY
+		self.armed = {}
+		self.stats = {}
+		self.lock = threading.Lock()
+		self.running = threading.Lock()
+
+	def arm(self, target, count):
+		with self.lock:
+			self.armed[target] = count
+			self.stats.pop(target, None)
+
+	def call(self, target, function, *args):
+		if not self.armed.get(target):
+			return function(*args)
+		# only one profile can be collected at a time
+		if not self.running.acquire(blocking=False):
+			return function(*args)
+		import cProfile
+		profile = cProfile.Profile()
+		try:
+			return profile.runcall(function, *args)
+		finally:
+			self.running.release()
+			self.add(target, profile)
+
+	def add(self, target, profile):
+		with self.lock:
+			if not self.armed.get(target):
+				return
+			if target in self.stats:
+				self.stats[target].add(profile)
+			else:
+				import pstats
+				self.stats[target] = pstats.Stats(profile)
+			self.armed[target] -= 1
+			if self.armed[target]:
+				return
+			del self.armed[target]
+			stats = self.stats.pop(target)
+		self.save(target, stats)
+
+	def save(self, target, stats):
+		os.makedirs(self.directory, exist_ok=True)
+		name = os.path.join(self.directory, f'{target}-{datetime.datetime.now():%Y%m%d-%H%M%S}-{os.getpid()}')
+		stats.dump_stats(name + '.prof')
+		with open(name + '.txt', 'w') as f:
+			stats.stream = f
+			stats.sort_stats('cumulative').print_stats(50)
+		print(f'profile: {name}.prof')
+
+	def files(self):
+		if not os.path.isdir(self.directory):
+			return []
+		return sorted((file for file in os.listdir(self.directory) if file.endswith(('.prof', '.txt'))), reverse=True)
+
+profiler = Profiler()
+
 class Device:
 	_subclasses = {}
 
@@ -167,11 +560,27 @@ class Device:
 		self.match_def_path = self.device.get('match_def_path')
 		self.match_scores_path = self.device.get('match_scores_path')
 		self.enabled = self.device.get('enabled')
+		self.poll_time = self.device.get('poll_time', 0)
+		self.save_raw = self.device.get('save_raw', False)
 		self.match_def = {}
 		self.match_scores = {}
+		self.match_def_raw = None
+		self.match_scores_raw = None
+		self.match_def_digest = None
+		self.match_scores_digest = None
+		self.saved_digests = (None, None)
+		self.polls = 0
+		self.changed = 0
+		self.unchanged = 0
+		self.registry = None
+		self.writer = None
 
 	def data(self):
-		return self.device
+		return self.device | {'polls': self.polls, 'changed': self.changed, 'unchanged': self.unchanged}
+
+	def publish(self):
+		if self.registry and self.match_def:
+			self.registry.update(self.id, self.match_def, self.match_scores)
 
 	def start(self):
 		self.update()
@@ -182,6 +591,59 @@ class Device:
 	def update(self):
 		raise NotImplementedError
 
+	def digest(self, raw):
+		if not raw:
+			return None
+		return hashlib.blake2b(raw, digest_size=16).digest()
+
+	def decode(self, raw):
+		return json.loads(raw) if raw else None
+
+	def receive(self, match_def_raw, match_scores_raw):
+		labels = (('device', self.id),)
+		self.polls += 1
+		match_def_digest = self.digest(match_def_raw)
+		match_scores_digest = self.digest(match_scores_raw)
+		if match_def_digest == self.match_def_digest and match_scores_digest == self.match_scores_digest:
+			self.unchanged += 1
+			metrics.inc('practiscore_payloads_total', labels + (('result', 'unchanged'),))
+			return False
+		metrics.inc('practiscore_payloads_total', labels + (('result', 'changed'),))
+
+		if match_def_digest != self.match_def_digest:
+			with metrics.timer('practiscore_decode_seconds', labels):
+				match_def = self.decode(match_def_raw)
+			if match_def:
+				self.match_def = match_def
+				self.match_def_raw = match_def_raw if self.save_raw else None
+
+		#if self.shutdown and self.shutdown == self.match_def.get('match_id'):
+		#	os.system('/usr/bin/sudo /usr/sbin/shutdown -h now')
+
+		if match_scores_digest != self.match_scores_digest:
+			with metrics.timer('practiscore_decode_seconds', labels):
+				match_scores = self.decode(match_scores_raw)
+			if match_scores:
+				self.match_scores = match_scores
+				self.match_scores_raw = match_scores_raw if self.save_raw else None
+		self.changed += 1
+		self.publish()
+		# set after publishing so a saved state never skips an unmerged payload
+		self.match_def_digest = match_def_digest
+		self.match_scores_digest = match_scores_digest
+		return True
+
+	def state(self):
+		return {'match_def': self.match_def, 'match_scores': self.match_scores, 'match_def_raw': self.match_def_raw, 'match_scores_raw': self.match_scores_raw, 'match_def_digest': self.match_def_digest, 'match_scores_digest': self.match_scores_digest}
+
+	def restore(self, state):
+		for key in state:
+			setattr(self, key, state[key])
+
+	async def poll(self):
+		await asyncio.to_thread(self.update)
+		return True
+
 @Device.register('PSDevice')
 class PSDevice(Device):
 	SIGNATURE = 0x19113006
@@ -196,6 +658,12 @@ class PSDevice(Device):
 	DEFAULT_PORT = 59623
 	DEFAULT_TIMEOUT = 5
 	DEFAULT_POLL_TIME = 10
+	DEFAULT_MAX_FRAME_SIZE = 16*1024*1024
+	DEFAULT_MAX_PAYLOAD_SIZE = 64*1024*1024
+	CHUNK_SIZE = 256*1024
+	# timeouts in a row on a reused connection before connecting for every poll, and for how many polls
+	REUSE_TIMEOUTS = 3
+	REUSE_PAUSE = 30
 
 	def __init__(self, device):
 		super().__init__(device)
@@ -203,78 +671,824 @@ class PSDevice(Device):
 		self.timeout = self.device.get('timeout', self.DEFAULT_TIMEOUT)
 		self.poll_time = self.device.get('poll_time', self.DEFAULT_POLL_TIME)
 		self.address = self.device.get('address')
+		self.max_frame_size = self.device.get('max_frame_size', self.DEFAULT_MAX_FRAME_SIZE)
+		self.max_payload_size = self.device.get('max_payload_size', self.DEFAULT_MAX_PAYLOAD_SIZE)
+		self.keep_alive = self.device.get('keep_alive', True)
+		self.connection = None
+		self.connection_reused = False
+		self.reuse_timeouts = 0
+		self.reuse_paused = 0
 
 	def update(self):
+		load_asyncio()
+		asyncio.run(self.poll_once())
+
+	async def poll_once(self):
+		# a connection cannot outlive the event loop of a one-off poll
 		try:
-			asyncio.run(asyncio.wait_for(self.update_async(), timeout=self.timeout))
+			await self.poll()
+		finally:
+			self.close()
+
+	async def poll(self):
+		labels = (('device', self.id),)
+		result = 'ok'
+		try:
+			match_def_raw, match_scores_raw = await asyncio.wait_for(self.fetch(), timeout=self.timeout)
+			# the timeout covers the network only: decoding and merging a large match may well take longer
+			await asyncio.to_thread(profiler.call, 'poll', self.receive, match_def_raw, match_scores_raw)
+			metrics.set('practiscore_device_last_success_timestamp_seconds', time.time(), labels)
+			if self.connection_reused:
+				self.reuse_timeouts = 0
 		except asyncio.exceptions.TimeoutError:
 			print(f'{self.id}: Timeout Error')
+			result = 'timeout'
+			if self.connection_reused:
+				self.reuse_timeouts += 1
+				if self.reuse_timeouts >= self.REUSE_TIMEOUTS:
+					print(f'{self.id}: no response on a reused connection {self.reuse_timeouts} times, connecting for every poll')
+					self.reuse_timeouts = 0
+					self.reuse_paused = self.REUSE_PAUSE
 		except OSError:
 			print(f'{self.id}: OSError')
-
-	async def update_async(self):
-		reader, writer = await asyncio.open_connection(self.address, self.port)
-
+			result = 'oserror'
+		except asyncio.IncompleteReadError:
+			print(f'{self.id}: Incomplete Read')
+			result = 'incomplete_read'
+		except self.PSInvalidHeader:
+			print(f'{self.id}: Invalid Header')
+			result = 'invalid_header'
+		except self.PSInvalidPayload as e:
+			print(f'{self.id}: Invalid Payload: {e}')
+			result = 'invalid_payload'
+		metrics.inc('practiscore_polls_total', labels + (('result', result),))
+		if result != 'ok':
+			self.close()
+		if self.reuse_paused:
+			self.reuse_paused -= 1
+			if not self.reuse_paused:
+				print(f'{self.id}: reusing connections again')
+		return result == 'ok'
+
+	async def connect(self, labels):
+		# reuse the last connection unless the tablet has closed it
+		if self.connection and not self.connection[0].at_eof():
+			self.connection_reused = True
+			metrics.inc('practiscore_connections_total', labels + (('result', 'reused'),))
+			return self.connection
+		self.close()
+		self.connection_reused = False
+		self.connection = await asyncio.open_connection(self.address, self.port)
+		metrics.inc('practiscore_connections_total', labels + (('result', 'opened'),))
+		return self.connection
+
+	def close(self):
+		if self.connection:
+			self.connection[1].close()
+			self.connection = None
+
+	async def fetch(self):
+		labels = (('device', self.id),)
+		start = time.perf_counter()
 		tx_data = struct.pack('!IIIII', self.SIGNATURE, self.LENGTH, self.MSG_MATCH_REQUEST, self.VERSION, int(time.time()))
-		writer.write(tx_data)
-		await writer.drain()
-
-		rx_header = await reader.readexactly(20)
+		reader, writer = await self.connect(labels)
+		try:
+			writer.write(tx_data)
+			await writer.drain()
+			rx_header = await reader.readexactly(20)
+		except (OSError, asyncio.IncompleteReadError):
+			# the tablet dropped the idle connection; retry once on a new one
+			if not self.connection_reused:
+				raise
+			self.close()
+			reader, writer = await self.connect(labels)
+			writer.write(tx_data)
+			await writer.drain()
+			rx_header = await reader.readexactly(20)
 
 		(f_signature, f_length, f_type, f_flags, f_time) = struct.unpack('!IIIII', rx_header)
 		f_signature_err = f_signature != self.SIGNATURE
 		f_type_err = f_type != self.MSG_MATCH_RESPONSE
 		f_flags_err = f_flags != self.VERSION
-		if f_signature_err or f_type_err or f_flags_err:
+		f_length_err = f_length < 4 or f_length > self.max_frame_size
+		if f_signature_err or f_type_err or f_flags_err or f_length_err:
 			raise self.PSInvalidHeader
 
 		match_def_length = struct.unpack('!I',await reader.readexactly(4))[0]
 		match_scores_length = f_length - match_def_length - 4
+		if match_scores_length < 0:
+			raise self.PSInvalidHeader
 
-		match_def = json.loads(zlib.decompress(await reader.readexactly(match_def_length)))
-		if match_def:
-			self.match_def = match_def
-
-		#if self.shutdown and self.shutdown == self.match_def.get('match_id'):
-		#	os.system('/usr/bin/sudo /usr/sbin/shutdown -h now')
-
-		if match_scores_length:
-			match_scores = json.loads(zlib.decompress(await reader.readexactly(match_scores_length)))
-			if match_scores:
-				self.match_scores = match_scores
-
-		writer.close()
-		await writer.wait_closed()
+		match_def_raw = await reader.readexactly(match_def_length)
+		match_scores_raw = await reader.readexactly(match_scores_length)
+		if not self.keep_alive or self.reuse_paused:
+			self.close()
+			await writer.wait_closed()
+		metrics.observe('practiscore_poll_seconds', time.perf_counter() - start, labels)
+		metrics.inc('practiscore_received_bytes_total', labels, 24 + f_length)
+		return match_def_raw, match_scores_raw
+
+	def decode(self, raw):
+		if not raw:
+			return None
+		decompressor = zlib.decompressobj()
+		data = bytearray()
+		tail = raw
+		try:
+			while True:
+				chunk = decompressor.decompress(tail, self.CHUNK_SIZE)
+				data += chunk
+				if len(data) > self.max_payload_size:
+					raise self.PSInvalidPayload(f'more than {self.max_payload_size} bytes')
+				tail = decompressor.unconsumed_tail
+				if not tail and len(chunk) < self.CHUNK_SIZE:
+					break
+			if not decompressor.eof:
+				raise self.PSInvalidPayload('truncated zlib stream')
+			return json.loads(data)
+		except (zlib.error, ValueError) as e:
+			raise self.PSInvalidPayload(str(e)) from e
 
 	def save(self):
+		if (self.match_def_digest, self.match_scores_digest) == self.saved_digests:
+			return
+		self.saved_digests = (self.match_def_digest, self.match_scores_digest)
 		if self.match_def and self.match_def_path:
-			with open(self.match_def_path, 'w') as f:
-				f.write(json.dumps(self.match_def))
+			self.store(self.match_def_path, self.match_def, self.match_def_raw)
 		if self.match_scores and self.match_scores_path:
-			with open(self.match_scores_path, 'w') as f:
-				f.write(json.dumps(self.match_scores))
+			self.store(self.match_scores_path, self.match_scores, self.match_scores_raw)
+
+	def store(self, path, value, raw):
+		if raw:
+			build = lambda: raw
+		else:
+			build = lambda: json.dumps(value).encode('utf-8')
+		if self.writer:
+			self.writer.write(path, build)
+		else:
+			write_atomic(path, build())
 
 	class PSInvalidHeader(Exception):
 		pass
 
+	class PSInvalidPayload(Exception):
+		pass
+
 @Device.register('FileDevice')
 class FileDevice(Device):
 	def update(self):
-		if self.match_def_path:
+		profiler.call('poll', self.receive, self.read(self.match_def_path), self.read(self.match_scores_path))
+
+	def read(self, path):
+		if not path:
+			return None
+		try:
+			with open(path, 'rb') as f:
+				return f.read()
+		except FileNotFoundError:
+			return None
+
+	def decode(self, raw):
+		# PSDevice.save_raw stores the zlib-compressed wire bytes verbatim
+		if raw and raw[:1] == b'\x78':
+			raw = zlib.decompress(raw)
+		return super().decode(raw)
+
+class Poller:
+	DEFAULT_MAX_IN_FLIGHT = 8
+	DEFAULT_MAX_BACKOFF = 300
+	JITTER = 0.1
+
+	def __init__(self, devices, config):
+		self.devices = devices
+		self.max_in_flight = config.get('max_in_flight', self.DEFAULT_MAX_IN_FLIGHT)
+		self.max_backoff = config.get('max_backoff', self.DEFAULT_MAX_BACKOFF)
+		self.loop = None
+		self.thread = None
+
+	def start(self):
+		self.thread = threading.Thread(target=self.run, name='poller', daemon=True)
+		self.thread.start()
+
+	def run(self):
+		load_asyncio()
+		asyncio.run(self.main())
+
+	async def main(self):
+		self.in_flight = asyncio.Semaphore(self.max_in_flight)
+		self.locks = {device: asyncio.Lock() for device in self.devices if device.poll_time}
+		self.loop = asyncio.get_running_loop()
+		await asyncio.gather(*(self.poll(device) for device in self.devices if device.poll_time))
+
+	async def poll(self, device):
+		# stagger the first poll so tablets sharing a poll_time do not fire together
+		await asyncio.sleep(random.uniform(0, device.poll_time))
+		failures = 0
+		while True:
+			async with self.in_flight, self.locks[device]:
+				try:
+					ok = await device.poll()
+				except Exception as e:
+					print(f'{device.id}: {e!r}')
+					ok = False
+			failures = 0 if ok else failures + 1
+			delay = min(device.poll_time * 2**failures, max(self.max_backoff, device.poll_time))
+			await asyncio.sleep(delay * random.uniform(1 - self.JITTER, 1 + self.JITTER))
+
+	def update(self, device):
+		# a kept-alive connection belongs to this loop, so polls asked for by other threads run on it too
+		if not (self.loop and device in self.locks):
+			return device.update()
+		asyncio.run_coroutine_threadsafe(self.update_async(device), self.loop).result()
+
+	async def update_async(self, device):
+		async with self.locks[device]:
+			await device.poll()
+
+class MatchRegistry:
+	HISTORY = 256
+	STATE_RETRIES = 3
+
+	def __init__(self):
+		self.matches = {}
+		self.sources = {}
+		self.lock = threading.Lock()
+		self.changed = threading.Condition(self.lock)
+		self.epoch = int(time.time())
+		self.version = 0
+		self.modified = datetime.datetime.now(datetime.timezone.utc)
+		self.history = collections.deque(maxlen=self.HISTORY)
+		self.index = MergeIndex()
+		self.journal = None
+		self.merges = 0
+
+	def update(self, source, match_def, match_scores):
+		match_id = match_def.get('match_id', '')
+		with self.lock, metrics.timer('practiscore_merge_seconds', (('device', source),)):
+			self.merges += 1
+			shooters, stages, scores = self.index.merge(source, match_id, match_def, match_scores)
+			modified = match_id not in self.matches or is_modified(match_def.get('match_modifieddate'), self.matches[match_id])
+			if match_id in self.matches:
+				changed = self.matches[match_id].merge(match_def, shooters, stages, scores)
+			else:
+				match = Match.create(match_def, match_scores)
+				if not match:
+					self.index.drop(match_id)
+					return
+				self.matches[match_id] = match
+				changed = True
+			changed_match_ids = [match_id] if changed else []
+			previous_match_id = self.sources.get(source)
+			if self.journal:
+				self.journal.append(source, match_id, match_def, modified, shooters, stages, scores)
+			self.sources[source] = match_id
+			if previous_match_id is not None and previous_match_id not in self.sources.values():
+				del self.matches[previous_match_id]
+				self.index.drop(previous_match_id)
+				changed_match_ids.append(previous_match_id)
+			if changed_match_ids:
+				self.version += 1
+				self.modified = datetime.datetime.now(datetime.timezone.utc)
+				self.history.extend((self.version, id) for id in changed_match_ids)
+				if match_id in self.matches:
+					self.matches[match_id].version = self.version
+				self.changed.notify_all()
+
+	def etag(self, version=None):
+		return f'{self.epoch:x}-{self.version if version is None else version}'
+
+	def parse_etag(self, etag):
+		try:
+			epoch, version = etag.split('-')
+			if int(epoch, 16) == self.epoch:
+				return int(version)
+		except (AttributeError, ValueError):
+			pass
+		return None
+
+	def changed_since(self, version):
+		if version is None or not self.history or self.history[0][0] > version + 1:
+			return list(self.matches)
+		return list(dict.fromkeys(id for v, id in self.history if v > version))
+
+	def wait(self, version, timeout):
+		with self.changed:
+			self.changed.wait_for(lambda: self.version != version, timeout)
+			if self.version == version:
+				return None
+			return {'version': self.etag(), 'matches': self.changed_since(version)}
+
+	def data(self):
+		with self.lock:
+			return [self.matches[id].data() for id in self.matches]
+
+	def match(self, match_id):
+		return self.matches.get(match_id)
+
+	def delta(self, match_id, since):
+		with self.lock:
+			if match_id not in self.matches:
+				return None
+			since = self.parse_etag(since)
+			if since is not None and since > self.version:
+				since = None
+			self.matches[match_id].post_process()
+			return self.matches[match_id].delta(since, self.etag())
+
+	def ranking(self, match_id, division=None, start=0, count=None, stage=None):
+		with self.lock:
+			if match_id not in self.matches:
+				return None
+			page = self.matches[match_id].ranking(division, start, count, stage)
+			return page and page | {'version': self.etag()}
+
+	def state(self):
+		# pickled outside the lock and kept only if no merge ran meanwhile;
+		# None when merges kept landing, to be tried again on the next change
+		for attempt in range(self.STATE_RETRIES):
+			with self.lock:
+				merges = self.merges
+				state = {'version': self.version, 'history': self.history, 'sources': self.sources, 'matches': self.matches, 'index': self.index}
 			try:
-				with open(self.match_def_path, 'r') as f:
-					self.match_def = json.load(f)
-			except FileNotFoundError:
-				pass
-		if self.match_scores_path:
+				data = pickle.dumps(state, pickle.HIGHEST_PROTOCOL)
+			except RuntimeError:
+				continue
+			with self.lock:
+				if self.merges == merges:
+					return data
+		return None
+
+	def restore(self, state):
+		with self.changed:
+			self.version = state['version']
+			self.history = state['history']
+			self.sources = state['sources']
+			self.matches = state['matches']
+			self.index = state['index']
+			self.modified = datetime.datetime.now(datetime.timezone.utc)
+			self.changed.notify_all()
+
+	def snapshot(self):
+		# pickled under the lock because match data shares dicts with the model
+		with self.lock:
+			matches = [self.matches[id].data() for id in self.matches]
+			return pickle.dumps({'epoch': self.epoch, 'version': self.version, 'modified': self.modified, 'history': self.history, 'matches': matches}, pickle.HIGHEST_PROTOCOL)
+
+class MergeIndex:
+	# the winning (mod date, source) of every entity keyed by (match_id, stage_uuid, shtr),
+	# with shooters as (match_id, None, sh_uid) and stages as (match_id, stage_uuid, None);
+	# ties on the mod date go to the greater source id, whatever order sources arrive in
+	MISSING = object()
+
+	def __init__(self):
+		self.winners = {}
+		self.seen = {}
+
+	def merge(self, source, match_id, match_def, match_scores):
+		# entities this source changed since its last payload that win over every other source
+		seen_shooters, seen_stages, seen_scores = self.seen.setdefault((source, match_id), ({}, {}, {}))
+		shooters, stages, scores = [], [], []
+		for match_shooter in match_def.get('match_shooters', ()):
+			shooter_id, modified_date = match_shooter.get('sh_uid'), match_shooter.get('sh_mod')
+			if seen_shooters.get(shooter_id, self.MISSING) != modified_date:
+				seen_shooters[shooter_id] = modified_date
+				if self.wins((match_id, None, shooter_id), modified_date, source):
+					shooters.append(match_shooter)
+		for match_stage in match_def.get('match_stages', ()):
+			stage_id, modified_date = match_stage.get('stage_uuid'), match_stage.get('stage_modifieddate')
+			if seen_stages.get(stage_id, self.MISSING) != modified_date:
+				seen_stages[stage_id] = modified_date
+				if self.wins((match_id, stage_id, None), modified_date, source):
+					stages.append(match_stage)
+		for stage in match_scores.get('match_scores', ()):
+			stage_id = stage.get('stage_uuid')
+			seen = seen_scores.setdefault(stage_id, {})
+			for stage_stagescore in stage.get('stage_stagescores'):
+				shooter_id, modified_date = stage_stagescore.get('shtr'), stage_stagescore.get('mod')
+				if seen.get(shooter_id, self.MISSING) != modified_date:
+					seen[shooter_id] = modified_date
+					if self.wins((match_id, stage_id, shooter_id), modified_date, source):
+						scores.append((stage_id, stage_stagescore))
+		return shooters, stages, scores
+
+	def wins(self, key, modified_date, source):
+		if key in self.winners:
+			winner_date, winner_source = self.winners[key]
+			# mod dates of one layout order as strings; stamps are only parsed across layouts
+			if winner_date and modified_date and len(winner_date) == len(modified_date):
+				if (winner_date, winner_source) >= (modified_date, source):
+					return False
+			elif (date_stamp(winner_date), winner_source) >= (date_stamp(modified_date), source):
+				return False
+		self.winners[key] = (modified_date, source)
+		return True
+
+	def drop(self, match_id):
+		self.winners = {key: self.winners[key] for key in self.winners if key[0] != match_id}
+		self.seen = {key: self.seen[key] for key in self.seen if key[1] != match_id}
+
+class Journal:
+	# the entities that won each merge, appended to numbered segments of
+	# length-prefixed zlib pickles; checkpoint N is the compacted state of
+	# every segment before N, written once segment N is started
+	SEGMENT_SIZE = 4*1024*1024
+	FRAME = struct.Struct('!I')
+	ENTITIES = ('match_shooters', 'match_stages')
+
+	def __init__(self, directory, segment_size=SEGMENT_SIZE):
+		self.directory = directory
+		self.segment_size = segment_size
+		self.lock = threading.Lock()
+		self.file = None
+		self.segment = None
+		self.sources = {}
+		self.last = 0
+
+	def path(self, segment, suffix):
+		return os.path.join(self.directory, f'{segment:08d}.{suffix}')
+
+	def numbers(self, suffix):
+		try:
+			names = os.listdir(self.directory)
+		except FileNotFoundError:
+			return []
+		return sorted(int(name.partition('.')[0]) for name in names if name.endswith(f'.{suffix}') and name.partition('.')[0].isdigit())
+
+	def append(self, source, match_id, match_def, modified, shooters, stages, scores):
+		# the header goes in when the registry took it, and with the first
+		# record of a match new to the journal or dropped since
+		with self.lock:
+			new = match_id not in self.sources.values()
+			if not (modified or new or shooters or stages or scores or self.sources.get(source) != match_id):
+				return
+			# times only move forward so a replay can stop at the first later record
+			self.last = max(time.time(), self.last)
+			record = {'time': self.last, 'source': source, 'match_id': match_id, 'shooters': shooters, 'stages': stages, 'scores': scores}
+			if modified or new:
+				record['header'] = {key: match_def[key] for key in match_def if key not in self.ENTITIES}
+			blob = zlib.compress(pickle.dumps(record, pickle.HIGHEST_PROTOCOL), 1)
 			try:
-				with open(self.match_scores_path, 'r') as f:
-					self.match_scores = json.load(f)
-			except FileNotFoundError:
+				if not self.file:
+					self.open()
+				self.file.write(self.FRAME.pack(len(blob)) + blob)
+				self.file.flush()
+				if self.file.tell() >= self.segment_size:
+					self.rotate()
+			except OSError as e:
+				print(f'{self.directory}: {e}')
+				self.close()
+				return
+			self.sources[source] = match_id
+		metrics.inc('practiscore_journal_records_total')
+		metrics.inc('practiscore_journal_bytes_total', value=self.FRAME.size + len(blob))
+
+	def open(self):
+		os.makedirs(self.directory, exist_ok=True)
+		segments = self.numbers('log')
+		self.segment = segments[-1] if segments else 0
+		# drop a record torn by a crash mid-write
+		end = 0
+		for end, record in self.records(self.segment):
+			self.last = max(record['time'], self.last)
+		self.file = open(self.path(self.segment, 'log'), 'ab')
+		self.file.truncate(end)
+		self.sources = {}
+
+	def rotate(self):
+		self.file.close()
+		self.segment += 1
+		self.file = open(self.path(self.segment, 'log'), 'ab')
+		threading.Thread(target=self.checkpoint, args=(self.segment,), name='checkpoint', daemon=True).start()
+
+	def close(self):
+		with contextlib.suppress(OSError):
+			if self.file:
+				self.file.close()
+		self.file = None
+
+	def checkpoint(self, segment, state=None):
+		start = time.perf_counter()
+		if state is None:
+			state = self.state(before=segment)
+		try:
+			write_atomic(self.path(segment, 'checkpoint'), zlib.compress(pickle.dumps(state, pickle.HIGHEST_PROTOCOL), 1))
+		except OSError as e:
+			print(f'{self.directory}: {e}')
+			return
+		print(f'{self.path(segment, "checkpoint")}: {len(state["matches"])} matches in {(time.perf_counter() - start)*1000:.0f} ms')
+
+	def seed(self, payloads):
+		# checkpoint 0 from the (source, match_def, match_scores) a restored
+		# registry was merged from, so an empty journal starts where it left off
+		index = MergeIndex()
+		state = {'time': time.time(), 'segment': 0, 'sources': {}, 'matches': {}}
+		for source, match_def, match_scores in payloads:
+			match_id = match_def.get('match_id', '')
+			shooters, stages, scores = index.merge(source, match_id, match_def, match_scores)
+			record = {'time': state['time'], 'source': source, 'match_id': match_id, 'shooters': shooters, 'stages': stages, 'scores': scores}
+			header = state['matches'].get(match_id, {}).get('header')
+			if not header or date_stamp(match_def.get('match_modifieddate')) > date_stamp(header.get('match_modifieddate')):
+				record['header'] = {key: match_def[key] for key in match_def if key not in self.ENTITIES}
+			self.apply(state, record)
+		with self.lock:
+			self.last = max(state['time'], self.last)
+		os.makedirs(self.directory, exist_ok=True)
+		self.checkpoint(0, state)
+
+	def records(self, segment):
+		# (end offset, record) up to the first torn or corrupt frame
+		try:
+			f = open(self.path(segment, 'log'), 'rb')
+		except FileNotFoundError:
+			return
+		with f:
+			while True:
+				head = f.read(self.FRAME.size)
+				if len(head) < self.FRAME.size:
+					return
+				(length,) = self.FRAME.unpack(head)
+				blob = f.read(length)
+				if len(blob) < length:
+					return
+				try:
+					record = pickle.loads(zlib.decompress(blob))
+				except Exception:
+					return
+				yield f.tell(), record
+
+	def load_checkpoint(self, segment):
+		try:
+			with open(self.path(segment, 'checkpoint'), 'rb') as f:
+				return pickle.loads(zlib.decompress(f.read()))
+		except Exception as e:
+			print(f'{self.path(segment, "checkpoint")}: {e!r}')
+			return None
+
+	def state(self, at=None, before=None):
+		# the latest checkpoint taken by time at, then the records after it up to at
+		state = None
+		for segment in reversed(self.numbers('checkpoint')):
+			if before is None or segment <= before:
+				state = self.load_checkpoint(segment)
+				if state and (at is None or state['time'] <= at):
+					break
+				state = None
+		if not state:
+			state = {'time': 0, 'segment': 0, 'sources': {}, 'matches': {}}
+		for segment in self.numbers('log'):
+			if segment < state['segment'] or (before is not None and segment >= before):
+				continue
+			for end, record in self.records(segment):
+				if at is not None and record['time'] > at:
+					return state
+				self.apply(state, record)
+			state['segment'] = segment + 1
+		if before is not None:
+			state['segment'] = before
+		return state
+
+	def apply(self, state, record):
+		# the same bookkeeping as MatchRegistry.update on entity dicts
+		match_id = record['match_id']
+		match = state['matches'].setdefault(match_id, {'header': {}, 'shooters': {}, 'stages': {}, 'scores': {}})
+		if 'header' in record:
+			match['header'] = record['header']
+		for match_shooter in record['shooters']:
+			match['shooters'][match_shooter.get('sh_uid')] = match_shooter
+		for match_stage in record['stages']:
+			match['stages'][match_stage.get('stage_uuid')] = match_stage
+		for stage_id, stage_stagescore in record['scores']:
+			match['scores'].setdefault(stage_id, {})[stage_stagescore.get('shtr')] = stage_stagescore
+		sources = state['sources']
+		previous_match_id = sources.get(record['source'])
+		sources[record['source']] = match_id
+		if previous_match_id is not None and previous_match_id not in sources.values():
+			state['matches'].pop(previous_match_id, None)
+		state['time'] = record['time']
+
+	def replay(self, registry, at=None):
+		state = self.state(at)
+		sources = state['sources']
+		for match_id, match in state['matches'].items():
+			match_def = match['header'] | {'match_shooters': list(match['shooters'].values()), 'match_stages': list(match['stages'].values())}
+			match_scores = {'match_id': match_id, 'match_scores': [{'stage_uuid': stage_id, 'stage_stagescores': list(scores.values())} for stage_id, scores in match['scores'].items()]}
+			# merged as the greatest of its sources so ties with their next payloads keep the replayed entities
+			registry.update(max(source for source in sources if sources[source] == match_id), match_def, match_scores)
+		registry.sources.update(sources)
+		return registry
+
+class SnapshotRegistry(MatchRegistry):
+	RETRY = 1
+	TIMEOUT = 30
+
+	def __init__(self, address, authkey):
+		super().__init__()
+		self.address = address
+		self.authkey = authkey
+		self.epoch = 0
+		self.match_data = []
+		self.thread = threading.Thread(target=self.run, name='snapshot', daemon=True)
+		self.thread.start()
+
+	def run(self):
+		while True:
+			try:
+				with multiprocessing.connection.Client(self.address, authkey=self.authkey) as connection:
+					while True:
+						connection.send(('wait', self.epoch, self.version, self.TIMEOUT))
+						snapshot = connection.recv()
+						if snapshot:
+							self.load(pickle.loads(snapshot))
+			except (OSError, EOFError) as e:
+				print(f'snapshot: {e!r}')
+				time.sleep(self.RETRY)
+
+	def load(self, snapshot):
+		with self.changed:
+			self.epoch = snapshot['epoch']
+			self.version = snapshot['version']
+			self.modified = snapshot['modified']
+			self.history = snapshot['history']
+			self.match_data = snapshot['matches']
+			self.matches = dict.fromkeys(match_data['id'] for match_data in self.match_data)
+			self.changed.notify_all()
+
+	def call(self, *request):
+		with multiprocessing.connection.Client(self.address, authkey=self.authkey) as connection:
+			connection.send(request)
+			return connection.recv()
+
+	def data(self):
+		return self.match_data
+
+	def match(self, match_id):
+		return None
+
+	def delta(self, match_id, since):
+		# rows are only kept as hashes, so the parent serializes the changed ones
+		return self.call('delta', match_id, since)
+
+	def ranking(self, match_id, division=None, start=0, count=None, stage=None):
+		with self.lock:
+			for match_data in self.match_data:
+				if match_data['id'] == match_id:
+					page = ranking_page(match_data, division, start, count, stage)
+					return page and page | {'version': self.etag()}
+			return None
+
+class SnapshotPublisher:
+	def __init__(self, kiosk, address, authkey):
+		self.kiosk = kiosk
+		self.registry = kiosk.registry
+		self.address = address
+		self.authkey = authkey
+		self.cache = None
+		self.lock = threading.Lock()
+
+	def start(self):
+		if os.path.exists(self.address):
+			os.unlink(self.address)
+		self.listener = multiprocessing.connection.Listener(self.address, family='AF_UNIX', authkey=self.authkey)
+		threading.Thread(target=self.run, name='publisher', daemon=True).start()
+
+	def run(self):
+		while True:
+			try:
+				connection = self.listener.accept()
+			except (OSError, EOFError, multiprocessing.AuthenticationError) as e:
+				print(f'publisher: {e!r}')
+				continue
+			threading.Thread(target=self.handle, args=(connection,), daemon=True).start()
+
+	def handle(self, connection):
+		with connection:
+			try:
+				while True:
+					request = connection.recv()
+					connection.send(self.reply(*request))
+			except (OSError, EOFError):
 				pass
 
+	def reply(self, kind, *args):
+		if kind == 'wait':
+			epoch, version, timeout = args
+			registry = self.registry
+			with registry.changed:
+				registry.changed.wait_for(lambda: (registry.epoch, registry.version) != (epoch, version), timeout)
+				if (registry.epoch, registry.version) == (epoch, version):
+					return None
+			return self.snapshot()
+		if kind == 'update':
+			return self.kiosk.update()
+		if kind == 'save':
+			return self.kiosk.save_device(*args)
+		if kind == 'delta':
+			return self.registry.delta(*args)
+		if kind == 'devices':
+			return self.kiosk.device_data()
+		if kind == 'device':
+			return self.kiosk.device_payload(*args)
+		if kind == 'metrics':
+			return self.kiosk.metrics()
+		if kind == 'profile':
+			return self.kiosk.profile(*args)
+		if kind == 'profiling':
+			return self.kiosk.profiling()
+		return None
+
+	def snapshot(self):
+		# every worker asks for the same version, so pickle it once
+		with self.lock:
+			if not self.cache or self.cache[0] != self.registry.version:
+				self.cache = (self.registry.version, self.registry.snapshot())
+			return self.cache[1]
+
+def kiosk_page_time(profile):
+	# a missing, non-numeric or non-positive page_time falls back to the default
+	page_time = profile.get('page_time')
+	return page_time if isinstance(page_time, (int, float)) and page_time > 0 else KIOSK_PAGE_TIME
+
+def kiosk_pages(matches, profile):
+	# the profile's matches, divisions and stages, split into pages of at most `rows` shooters
+	matches = {match_data['id']: match_data for match_data in matches}
+	pages = []
+	for match_id in profile.get('matches') or matches:
+		match_data = matches.get(match_id)
+		if not match_data:
+			continue
+		stages = [stage for stage in match_data['stages'] if not profile.get('stages') or stage['number'] in profile['stages']]
+		shooters = [(division, shooter) for division in sorted(match_data['divisions']) if not profile.get('divisions') or division in profile['divisions'] for shooter in match_data['divisions'][division]]
+		if not shooters and profile.get('divisions'):
+			continue
+		rows = profile.get('rows') or len(shooters) or 1
+		for start in range(0, max(len(shooters), 1), rows):
+			divisions = {}
+			for division, shooter in shooters[start:start+rows]:
+				divisions.setdefault(division, []).append(shooter)
+			pages.append(match_data | {'stages': stages, 'divisions': divisions})
+	return pages or [{'id': '', 'name': '', 'sub_type': None, 'stages': [], 'divisions': {}}]
+
+def ranking_page(match_data, division=None, start=0, count=None, stage=None):
+	if stage is not None:
+		stage_ranking = match_data.get('stage_rankings', {}).get(stage)
+		page = stage_ranking and ranking_page(match_data | stage_ranking, division, start, count)
+		return page and page | {'stage': stage}
+	rows = match_data['combined']['Combined'] if division is None else match_data['divisions'].get(division)
+	if rows is None:
+		return None
+	end = len(rows) if count is None else start+count
+	return {'id': match_data['id'], 'name': match_data['name'], 'division': division or 'Combined', 'total': len(rows), 'start': start, 'rows': rows[start:end]}
+
+def delta_json(header, rows, since, version, row):
+	kinds = {'stage': [], 'shooter': [], 'score': []}
+	for key in rows:
+		if since is None or rows[key][0] > since:
+			kinds[key[0]].append(json.dumps(row(key), sort_keys=True))
+	header = json.dumps(header | {'version': version, 'full': since is None})
+	return header[:-1] + ''.join(f', "{kind}s": [{", ".join(kinds[kind])}]' for kind in kinds) + '}'
+
+class Ranking:
+	# ids kept sorted by (key, order) with their ranked rows; an update moves
+	# the changed ids by bisection and rebuilds only the rows whose place can
+	# have moved, or every row once the leader changed
+	def __init__(self, row, stage_id, entries):
+		self.row = row
+		self.stage_id = stage_id
+		self.entries = entries
+		self.keys = sorted((key, order, id) for id, (key, order) in entries.items())
+		self.rows = self.build(0, len(self.keys))
+
+	def build(self, start, end):
+		leader = self.keys[0][2] if self.keys else None
+		return [self.row(self.stage_id, self.keys[i][2], i+1, leader) for i in range(start, end)]
+
+	def update(self, entries):
+		leader = self.keys[0] if self.keys else None
+		low, high = len(self.keys), -1
+		for id in entries:
+			if id in self.entries:
+				i = bisect.bisect_left(self.keys, (*self.entries.pop(id), id))
+				del self.keys[i]
+				low, high = min(low, i), max(high, i)
+			if entries[id] is not None:
+				self.entries[id] = entries[id]
+				i = bisect.bisect_left(self.keys, (*entries[id], id))
+				self.keys.insert(i, (*entries[id], id))
+				low, high = min(low, i), max(high, i)
+		if high < 0:
+			return
+		if not self.keys or self.keys[0] != leader or len(self.keys) != len(self.rows):
+			self.rows = self.build(0, len(self.keys))
+		else:
+			# ids past every touched index are back in place once the count is unchanged
+			high = min(high + len(entries), len(self.keys) - 1)
+			self.rows = self.rows[:low] + self.build(low, high+1) + self.rows[high+1:]
+
 class Match:
 	_subclasses = {}
+	engine = None
+	# what a saved state keeps: the entities and match data; every result is rebuilt from them
+	STATE = ('id', 'sub_type', 'shooters', 'stages', 'scores', 'name', 'modified_date', 'modified_stamp', 'match_pfs', 'version', 'engine')
 
 	@classmethod
 	def register(cls, sub_type):
@@ -296,106 +1510,310 @@ class Match:
 		self.shooters = {}
 		self.stages = {}
 		self.scores = {}
+		self.version = 0
+		self.reset()
 		self.update_match_data(match_def)
 		self.update(match_def, match_scores)
 
+	def reset(self):
+		self.dirty_all = True
+		self.dirty_shooters = set()
+		self.dirty_scores = set()
+		self.dirty_stage_divisions = set()
+		self.post_process_counts = {}
+		self.rows = {}
+		self.shooter_rows = {}
+		self.rankings = {}
+		self.combined = []
+		self.stage_rankings = {}
+
+	def __getstate__(self):
+		return {key: self.__dict__[key] for key in self.STATE if key in self.__dict__}
+
+	def __setstate__(self, state):
+		self.__dict__.update(state)
+		self.reset()
+
 	def data(self):
 		self.post_process()
-		return {'name': self.name, 'id': self.id, 'stages': self.stage_data, 'scores': self.score_data(), 'sub_type': self.sub_type, 'divisions': self.shooter_by_division(), 'combined': self.shooter_combined()}	
+		return {'name': self.name, 'id': self.id, 'stages': self.stage_data, 'scores': self.score_data(), 'sub_type': self.sub_type, 'divisions': self.shooter_by_division(), 'combined': self.shooter_combined(), 'post_process': self.post_process_counts}	
 
 	def post_process(self):
-		self.stage_list = [id for id in self.stages if not self.stages[id].deleted]
-		self.shooter_list = [id for id in self.shooters if not self.shooters[id].disqualified and not self.shooters[id].deleted]
-		self.divisions = {self.shooters[id].division for id in self.shooter_list}
-		self.shooter_list_by_division = {division: [id for id in self.shooter_list if self.shooters[id].division == division] for division in self.divisions}
-		for stage_id in self.scores:
-			for shooter_id in self.scores[stage_id]:
+		# A changed score dirties its (stage, division) max, which dirties that
+		# division's shooter results for the stage only when the max moved.
+		if not (self.dirty_all or self.dirty_shooters or self.dirty_scores or self.dirty_stage_divisions):
+			return
+		start = time.perf_counter()
+		score_count = sum(len(self.scores[stage_id]) for stage_id in self.scores)
+		if self.engine and len(self.dirty_scores) > score_count*self.engine.FULL_PASS_RATIO:
+			self.dirty_all = True
+		if self.dirty_all:
+			self.dirty_shooters.update(self.shooters)
+			self.dirty_scores = {(stage_id, shooter_id) for stage_id in self.scores for shooter_id in self.scores[stage_id]}
+		if self.dirty_all or self.dirty_shooters:
+			self.stage_list = [id for id in self.stages if not self.stages[id].deleted]
+			self.shooter_list = [id for id in self.shooters if not self.shooters[id].disqualified and not self.shooters[id].deleted]
+			self.divisions = {self.shooters[id].division for id in self.shooter_list}
+			self.shooter_list_by_division = {division: [id for id in self.shooter_list if self.shooters[id].division == division] for division in self.divisions}
+		if self.dirty_all:
+			divisions = {self.shooters[id].division for id in self.shooters}
+			self.dirty_stage_divisions.update((stage_id, division) for stage_id in self.stage_list for division in divisions)
+		else:
+			for shooter_id in self.dirty_shooters:
+				self.dirty_scores.update((stage_id, shooter_id) for stage_id in self.scores if shooter_id in self.scores[stage_id])
+		dirty_results = {}
+		results = {}
+		if self.engine and self.dirty_all:
+			results = self.engine.post_process(self)
+			self.dirty_stage_divisions.update((stage_id, self.shooters[shooter_id].division) for stage_id, shooter_id in self.dirty_scores if shooter_id in self.shooters)
+		else:
+			for stage_id, shooter_id in self.dirty_scores:
 				self.scores[stage_id][shooter_id].post_process()
-		for id in self.stage_list:
-			self.stages[id].post_process()
-		for id in self.shooter_list:
-			self.shooters[id].post_process()
+				if shooter_id in self.shooters:
+					self.dirty_stage_divisions.add((stage_id, self.shooters[shooter_id].division))
+					dirty_results.setdefault(shooter_id, set()).add(stage_id)
+			for stage_id, division in self.dirty_stage_divisions:
+				if stage_id in self.stages and not self.stages[stage_id].deleted:
+					if self.stages[stage_id].post_process(division):
+						for shooter_id in self.shooter_list_by_division.get(division, []):
+							dirty_results.setdefault(shooter_id, set()).add(stage_id)
+		shooter_stages = 0
+		for shooter_id in self.dirty_shooters:
+			self.shooters[shooter_id].post_process(None, results.get(shooter_id))
+			shooter_stages += len(self.stage_list)
+		for shooter_id in dirty_results:
+			if shooter_id not in self.dirty_shooters:
+				self.shooters[shooter_id].post_process(dirty_results[shooter_id])
+				shooter_stages += len(dirty_results[shooter_id])
+		stage_division_count = len(self.stage_list)*len(self.divisions)
+		shooter_stage_count = len(self.shooters)*len(self.stage_list)
+		self.post_process_counts = {'scores_computed': len(self.dirty_scores),
+			'scores_skipped': max(score_count-len(self.dirty_scores), 0),
+			'max_hit_factors_computed': len(self.dirty_stage_divisions),
+			'max_hit_factors_skipped': max(stage_division_count-len(self.dirty_stage_divisions), 0),
+			'shooter_stages_computed': shooter_stages,
+			'shooter_stages_skipped': max(shooter_stage_count-shooter_stages, 0)}
 		self.stage_data = [self.stages[id].data() for id in self.stage_list]
+		changed_shooters = self.dirty_shooters | dirty_results.keys()
+		for shooter_id in changed_shooters:
+			self.shooter_rows[shooter_id] = self.shooters[shooter_id].data()
+		self.rank({self.shooters[id].division for id in changed_shooters} | {division for stage_id, division in self.dirty_stage_divisions}, changed_shooters)
+		self.stamp_rows(self.stages if self.dirty_all else {stage_id for stage_id, division in self.dirty_stage_divisions}, changed_shooters, self.dirty_scores)
+		self.dirty_all = False
+		self.dirty_shooters = set()
+		self.dirty_scores = set()
+		self.dirty_stage_divisions = set()
+		metrics.observe('practiscore_post_process_seconds', time.perf_counter() - start, (('match', self.id),))
+
+	def rank(self, divisions, shooter_ids):
+		# only the divisions whose inputs changed are re-sorted; combined
+		# reuses the cached shooter rows
+		if self.dirty_all or self.dirty_shooters:
+			self.division_names = list(dict.fromkeys(self.shooters[id].division for id in self.shooters))
+		for division in divisions:
+			self.rankings[division] = self.rank_rows(self.shooter_list_by_division.get(division, []))
+		self.rankings = {division: self.rankings.get(division, []) for division in self.division_names}
+		self.combined = self.rank_rows(self.shooter_list)
+
+	def rank_rows(self, shooter_ids):
+		shooters = sorted((self.shooters[id] for id in shooter_ids), key=lambda shooter: shooter.rank_key())
+		return [self.shooter_rows[shooter.id] | {'place': place, 'percent': shooter.percent(shooters[0])} for place, shooter in enumerate(shooters, 1)]
+
+	def ranking(self, division=None, start=0, count=None, stage=None):
+		self.post_process()
+		return ranking_page({'id': self.id, 'name': self.name, 'divisions': self.rankings, 'combined': {'Combined': self.combined}, 'stage_rankings': self.stage_rankings}, division, start, count, stage)
+
+	def row(self, key):
+		if key[0] == 'stage':
+			return {'deleted': self.stages[key[1]].deleted} | self.stages[key[1]].data()
+		if key[0] == 'shooter':
+			shooter = self.shooters[key[1]]
+			return {'id': shooter.id, 'division': shooter.division, 'deleted': shooter.deleted, 'disqualified': shooter.disqualified} | self.shooter_rows[shooter.id]
+		return self.scores[key[1]][key[2]].data()
+
+	def stamp_rows(self, stage_ids, shooter_ids, score_ids):
+		# only the version and a hash of each row are kept; delta() serializes the rows it returns
+		keys = [('stage', id) for id in stage_ids if id in self.stages]
+		keys += [('shooter', id) for id in shooter_ids]
+		keys += [('score', stage_id, shooter_id) for stage_id, shooter_id in score_ids]
+		for key in keys:
+			digest = hash(json.dumps(self.row(key), sort_keys=True))
+			if key not in self.rows or self.rows[key][1] != digest:
+				self.rows[key] = (self.version, digest)
+
+	def delta(self, since, version):
+		return delta_json({'id': self.id, 'name': self.name, 'sub_type': self.sub_type}, self.rows, since, version, self.row)
 
 	def score_data(self):
 		return [[self.scores[stage_id][shooter_id].data() for stage_id in self.scores for shooter_id in self.scores[stage_id]]]
 
 	def shooter_by_division(self):
-		data = {}
-		for id in self.shooters:
-			shooter = self.shooters[id]
-			if not shooter.division in data:
-				data[shooter.division] = []
-			if not shooter.deleted and not shooter.disqualified:
-				data[shooter.division].append(shooter.data())
-		return data
+		return dict(self.rankings)
 
 	def shooter_combined(self):
-		data = {}
-		data['Combined'] = []
-		for id in self.shooters:
-			shooter = self.shooters[id]
-			if not shooter.deleted and not shooter.disqualified:
-				data['Combined'].append(shooter.data())
-		return data
+		return {'Combined': self.combined}
 
 	def update(self, match_def, match_scores):
+		changed = False
 		modified_date = match_def.get('match_modifieddate')
-		if is_modified(modified_date, self.modified_date):
+		if is_modified(modified_date, self):
 			self.update_match_data(match_def)
+			self.dirty_all = True
+			changed = True
 		if 'match_shooters' in match_def:
-			self.update_shooters(match_def.get('match_shooters'))
+			changed |= self.update_shooters(match_def.get('match_shooters'))
 		if 'match_stages' in match_def:
-			self.update_stages(match_def.get('match_stages'))
+			changed |= self.update_stages(match_def.get('match_stages'))
 		if 'match_scores' in match_scores:
-			self.update_scores(match_scores.get('match_scores'))
+			changed |= self.update_scores(match_scores.get('match_scores'))
+		return changed
+
+	def merge(self, match_def, shooters, stages, scores):
+		# the entities MergeIndex picked, applied whatever their stamps against the model
+		changed = False
+		if is_modified(match_def.get('match_modifieddate'), self):
+			self.update_match_data(match_def)
+			self.dirty_all = True
+			changed = True
+		for match_shooter in shooters:
+			changed |= self.update_shooter(match_shooter, True)
+		for match_stage in stages:
+			changed |= self.update_stage(match_stage, True)
+		for stage_id, stage_stagescore in scores:
+			changed |= self.update_score(stage_id, stage_stagescore, True)
+		return changed
 
 	def update_match_data(self, match_def):
 		self.name = match_def.get('match_name')
 		self.modified_date = match_def.get('match_modifieddate')
+		self.modified_stamp = date_stamp(self.modified_date)
 
 	def update_scores(self, match_scores):
+		changed = False
 		for stage in match_scores:
 			for stage_stagescore in stage.get('stage_stagescores'):
-				shooter_id = stage_stagescore.get('shtr')
-				stage_id = stage.get('stage_uuid')
-				if stage_id not in self.scores:
-					self.scores[stage_id] = {}
-				if shooter_id in self.scores[stage_id]:
-					self.scores[stage_id][shooter_id].update_if_modified(stage_stagescore)
-				else:
-					score = StageScore.create(self, stage_id, stage_stagescore)
-					if score:
-						self.scores[stage_id][shooter_id] = score
+				changed |= self.update_score(stage.get('stage_uuid'), stage_stagescore)
+		return changed
+
+	def update_score(self, stage_id, stage_stagescore, force=False):
+		shooter_id = stage_stagescore.get('shtr')
+		if stage_id not in self.scores:
+			self.scores[stage_id] = {}
+		if shooter_id in self.scores[stage_id]:
+			if self.scores[stage_id][shooter_id].update_if_modified(stage_stagescore, force):
+				self.dirty_scores.add((stage_id, shooter_id))
+				return True
+		else:
+			score = StageScore.create(self, stage_id, stage_stagescore)
+			if score:
+				self.scores[stage_id][shooter_id] = score
+				self.dirty_scores.add((stage_id, shooter_id))
+				return True
+		return False
 
-	def update_stage(self, match_stage):
+	def update_stage(self, match_stage, force=False):
 		stage_id = match_stage.get('stage_uuid')
 		if stage_id in self.stages:
-			self.stages[stage_id].update_if_modified(match_stage)
+			if self.stages[stage_id].update_if_modified(match_stage, force):
+				self.dirty_all = True
+				return True
 		else:
 			stage = Stage.create(self, match_stage)
 			if stage:
 				self.stages[stage_id] = stage
+				self.dirty_all = True
+				return True
+		return False
 
 	def update_stages(self, match_stages):
+		changed = False
 		for match_stage in match_stages:
-			self.update_stage(match_stage)
+			changed |= self.update_stage(match_stage)
+		return changed
 
-	def update_shooter(self, match_shooter):
+	def update_shooter(self, match_shooter, force=False):
 		shooter_id = match_shooter.get('sh_uid')
 		if shooter_id in self.shooters:
-			self.shooters[shooter_id].update_if_modified(match_shooter)
+			division = self.shooters[shooter_id].division
+			if self.shooters[shooter_id].update_if_modified(match_shooter, force):
+				self.dirty_shooters.add(shooter_id)
+				if self.shooters[shooter_id].division != division:
+					self.dirty_stage_divisions.update((stage_id, division) for stage_id in self.stages)
+				return True
 		else:
 			shooter = Shooter.create(self, match_shooter)
 			if shooter:
 				self.shooters[shooter_id] = shooter
+				self.dirty_shooters.add(shooter_id)
+				return True
+		return False
 
 	def update_shooters(self, match_shooters):
+		changed = False
 		for match_shooter in match_shooters:
-			self.update_shooter(match_shooter)
+			changed |= self.update_shooter(match_shooter)
+		return changed
+
+class IPSCArrayEngine:
+	# column-wise full pass over an IPSC match, equivalent to the per-object
+	# post_process path; used for large passes when numpy is available
+	FULL_PASS_RATIO = 0.5
+	# IPSCStageScore.HITS column of each ts nibble
+	NIBBLES = (0, 1, 2, 3, 5, 4, 6)
+
+	def post_process(self, match):
+		results = {}
+		for stage_id in match.scores:
+			hit_factors = self.score_stage(match, list(match.scores[stage_id].values()))
+			if stage_id in match.stages and not match.stages[stage_id].deleted:
+				self.rank_stage(match, match.stages[stage_id], hit_factors, results)
+		return results
+
+	def score_stage(self, match, scores):
+		if not scores:
+			return {}
+		lengths = numpy.fromiter((len(score.ts) for score in scores), dtype=numpy.int64, count=len(scores))
+		words = numpy.fromiter((x for score in scores for x in score.ts), dtype=numpy.int64, count=int(lengths.sum()))
+		rows = numpy.repeat(numpy.arange(len(scores)), lengths)
+		hits = numpy.zeros((len(scores), len(IPSCStageScore.HITS)), dtype=numpy.int64)
+		for nibble, column in enumerate(self.NIBBLES):
+			hits[:, column] = numpy.bincount(rows, weights=(words >> 4*nibble) & 0xf, minlength=len(scores))
+		hits[:, (0, 5, 4)] += numpy.array([score.poppers for score in scores], dtype=numpy.int64).reshape(-1, 3)
+		hits[:, 7] = numpy.fromiter((score.procedurals for score in scores), dtype=numpy.int64, count=len(scores))
+		pf = numpy.array([[score_pf.get(k, 0) for k in IPSCStageScore.HITS[:6]] for score_pf in (score.pf() for score in scores)])
+		points = (pf[:, :4]*hits[:, :4]).sum(axis=1)
+		penalties = (pf[:, 4:6]*hits[:, 4:6]).sum(axis=1) + 10*hits[:, 7]
+		time = numpy.array([score.time for score in scores], dtype=numpy.float64)
+		hit_factors = numpy.maximum(points-penalties, 0)/numpy.where(time == 0, 1, time)
+		for score, score_hits, score_points, score_penalties, hit_factor in zip(scores, hits.tolist(), points.tolist(), penalties.tolist(), hit_factors.tolist()):
+			score.hits = array.array('I', score_hits)
+			score.points = score_points
+			score.penalties = score_penalties
+			score.hit_factor = 0 if score.time == 0 else hit_factor
+		return {score.shooter_id: score for score in scores}
+
+	def rank_stage(self, match, stage, scores, results):
+		shooter_ids = [id for id in match.shooter_list if id in scores]
+		divisions = sorted({match.shooters[id].division for id in shooter_ids})
+		codes = {division: i for i, division in enumerate(divisions)}
+		division = numpy.array([codes[match.shooters[id].division] for id in shooter_ids], dtype=numpy.int64)
+		hit_factor = numpy.array([scores[id].hit_factor for id in shooter_ids], dtype=numpy.float64)
+		max_hit_factors = numpy.zeros(len(divisions))
+		numpy.maximum.at(max_hit_factors, division, hit_factor)
+		stage.max_hit_factors = {division: value if value > 0 else 0 for division, value in zip(divisions, max_hit_factors.tolist())}
+		stage.max_hit_factor = max(stage.max_hit_factors.values(), default=0)
+		max_hit_factor = max_hit_factors[division] if len(divisions) else hit_factor
+		ratio = hit_factor/numpy.where(max_hit_factor == 0, 1, max_hit_factor)
+		for id, stage_percent, match_points in zip(shooter_ids, (ratio*100).tolist(), (ratio*stage.max_points).tolist()):
+			results.setdefault(id, {})[stage.id] = (stage_percent, match_points)
 
 @Match.register('ipsc')
 class IPSCMatch(Match):
+	def __init__(self, match_def, match_scores):
+		if kiosk.config.get('engine') == 'numpy' and load_numpy():
+			self.engine = IPSCArrayEngine()
+		super().__init__(match_def, match_scores)
+
 	def update_match_data(self, match_def):
 		super().update_match_data(match_def)
 		self.match_pfs = {pf['name'].lower():pf for pf in match_def.get('match_pfs')}
@@ -406,7 +1824,50 @@ class IPSCMatch(Match):
 
 @Match.register('scsa')
 class SCSAMatch(Match):
-	pass
+	# each division, the combined list and every stage keep a Ranking that
+	# only moves the shooters and scores that changed
+	def data(self):
+		return super().data() | {'stage_rankings': self.stage_rankings}
+
+	def rank(self, divisions, shooter_ids):
+		if self.dirty_all or self.dirty_shooters:
+			self.division_names = list(dict.fromkeys(self.shooters[id].division for id in self.shooters))
+			self.order = {id: i for i, id in enumerate(self.shooter_list)}
+			self.division_ranking = {division: Ranking(self.ranked_row, None, {id: self.entry(None, id) for id in self.shooter_list_by_division[division]}) for division in self.shooter_list_by_division}
+			self.combined_ranking = Ranking(self.ranked_row, None, {id: self.entry(None, id) for id in self.shooter_list})
+			self.stage_ranking = {}
+			for stage_id in self.stage_list:
+				self.stage_ranking[stage_id] = {division: Ranking(self.ranked_row, stage_id, {id: self.entry(stage_id, id) for id in self.shooter_list_by_division[division] if self.entry(stage_id, id)}) for division in self.shooter_list_by_division}
+				self.stage_ranking[stage_id][None] = Ranking(self.ranked_row, stage_id, {id: self.entry(stage_id, id) for id in self.shooter_list if self.entry(stage_id, id)})
+		else:
+			shooter_ids = [id for id in shooter_ids if id in self.order]
+			for division in {self.shooters[id].division for id in shooter_ids}:
+				self.division_ranking[division].update({id: self.entry(None, id) for id in shooter_ids if self.shooters[id].division == division})
+			self.combined_ranking.update({id: self.entry(None, id) for id in shooter_ids})
+			for stage_id, shooter_id in self.dirty_scores:
+				if stage_id in self.stage_ranking and shooter_id in self.order:
+					entry = {shooter_id: self.entry(stage_id, shooter_id)}
+					self.stage_ranking[stage_id][self.shooters[shooter_id].division].update(entry)
+					self.stage_ranking[stage_id][None].update(entry)
+		self.rankings = {division: self.division_ranking[division].rows if division in self.division_ranking else [] for division in self.division_names}
+		self.combined = self.combined_ranking.rows
+		self.stage_rankings = {stage_id: {'divisions': {division: rankings[division].rows for division in rankings if division is not None}, 'combined': {'Combined': rankings[None].rows}} for stage_id, rankings in self.stage_ranking.items()}
+
+	def entry(self, stage_id, shooter_id):
+		# the (key, order) a shooter ranks by overall, or on a stage it has a score for
+		shooter = self.shooters[shooter_id]
+		if stage_id is None:
+			return (shooter.rank_key(), self.order[shooter_id])
+		if stage_id in shooter.missing:
+			return None
+		return (shooter.scores[stage_id], self.order[shooter_id])
+
+	def ranked_row(self, stage_id, shooter_id, place, leader_id):
+		shooter, leader = self.shooters[shooter_id], self.shooters[leader_id]
+		if stage_id is None:
+			return self.shooter_rows[shooter_id] | {'place': place, 'percent': shooter.percent(leader)}
+		time = shooter.scores[stage_id]
+		return {'id': shooter_id, 'name': shooter.name(), 'short_division': shooter.short_division, 'time': time, 'time_string': f'{time:.2f}', 'place': place, 'percent': leader.scores[stage_id]/time*100 if time else 0}
 
 #@Match.register('sass')
 #class SASSMatch(Match):
@@ -415,6 +1876,7 @@ class SCSAMatch(Match):
 
 class Shooter:
 	_subclasses = {}
+	__slots__ = ('id', 'match', 'firstname', 'lastname', 'division', 'short_division', 'deleted', 'disqualified', 'modified_date', 'modified_stamp')
 
 	@classmethod
 	def register(cls, sub_type):
@@ -435,22 +1897,25 @@ class Shooter:
 		self.match = match
 		self.update(match_shooter)
 
-	def update_if_modified(self, match_shooter):
+	def update_if_modified(self, match_shooter, force=False):
 		modified_date = match_shooter.get('sh_mod')
-		if is_modified(modified_date, self.modified_date):
+		if force or is_modified(modified_date, self):
 			self.update(match_shooter)
+			return True
+		return False
 
 	def update(self, match_shooter):
 		self.firstname = match_shooter.get('sh_fn', '')
 		self.lastname = match_shooter.get('sh_ln', '')
-		self.division = match_shooter.get('sh_dvp', '')
+		self.division = sys.intern(match_shooter.get('sh_dvp', ''))
 		if self.division in kiosk.division_name_substitutions:
-			self.short_division = kiosk.division_name_substitutions[self.division]
+			self.short_division = sys.intern(kiosk.division_name_substitutions[self.division])
 		else:
 			self.short_division = self.division
 		self.deleted = match_shooter.get('sh_del', False)
 		self.disqualified = match_shooter.get('sh_dq', False)
 		self.modified_date = match_shooter.get('sh_mod')
+		self.modified_stamp = date_stamp(self.modified_date)
 
 	def name(self):
 		return f'{self.firstname} {self.lastname}'
@@ -458,113 +1923,120 @@ class Shooter:
 	def data(self):
 		return {'name': self.name(),
 			'short_division': self.short_division}
-	def post_process(self):
+	def post_process(self, stage_ids=None, results=None):
 		pass
+	def rank_key(self):
+		return 0
+	def percent(self, leader):
+		return 100
 
 @Shooter.register('ipsc')
 class IPSCShooter(Shooter):
+	# results holds (state, stage_percent, match_points) per stage; the
+	# display strings are only built by data()
+	__slots__ = ('pf', 'results', 'match_points_total')
+	MISSING_HITS = {'A':'-', 'B':'-', 'C': '-', 'D': '-', 'M': '-', 'NS': '-', 'NPM': '-', 'Proc': '-'}
+
 	def update(self, match_shooter):
 		super().update(match_shooter)
-		self.pf = match_shooter.get('sh_pf', '')
-	def score_string(self, stage):
-		if not self.disqualified and stage.id in self.scores:
-			score = self.scores[stage.id]
-			if score.dnf:
-				return 'DNF'
-			if score.hit_factor != 0:
-				return score.hit_factor_string
-		return '-'
-	def scores(self):
-		self.match_points = {}
-		self.match_points_string = {}
-		self.stage_percent = {}
-		self.stage_percent_string = {}
-		self.hit_factor_string = {}
-		self.points_string = {}
-		self.time_string = {}
-		self.hits = {}
-		self.penalties = {}
+		self.pf = sys.intern(match_shooter.get('sh_pf', ''))
+	def post_process(self, stage_ids=None, results=None):
+		if stage_ids is None:
+			self.results = {}
+			stage_ids = self.match.stages
 		if not self.disqualified:
-			for stage_id in [id for id in self.match.stages if not self.match.stages[id].deleted]:
-				stage = self.match.stages[stage_id]
-				max_hit_factor = stage.max_hit_factors.get(self.division,0)
-				if stage_id in self.match.scores and self.id in self.match.scores[stage_id]:
-					score = self.match.scores[stage_id][self.id]
-					self.penalties[stage_id] = score.penalties
-					self.time_string[stage_id] = score.time_string
-					self.hits[stage_id] = score.hits
-					self.penalties[stage_id] = score.penalties
-					if score.dnf :
-						self.stage_percent[stage_id] = 0
-						self.stage_percent_string[stage_id] = 'DNF'
-						self.match_points[stage_id] = 0
-						self.match_points_string[stage_id] = 'DNF'
-						self.time_string[stage_id] = 'DNF'
-						self.hit_factor_string[stage_id] = 'DNF'
-						self.points_string[stage_id] = 'DNF'
-					elif score.time == 0:
-						self.stage_percent[stage_id] = 0
-						self.stage_percent_string[stage_id] = '-'
-						self.match_points[stage_id] = 0
-						self.match_points_string[stage_id] = '-'
-						self.time_string[stage_id] = '-'
-						self.hit_factor_string[stage_id] = '-'
-						self.points_string[stage_id] = '-'
-					elif score.hit_factor == 0 or max_hit_factor == 0:
-						self.stage_percent[stage_id] = 0
-						self.stage_percent_string[stage_id] = f'{0:.2f} %'
-						self.match_points[stage_id] = 0
-						self.match_points_string[stage_id] = f'{0:.4f}'
-						self.time_string[stage_id] = f'{0:.2f}'
-						self.hit_factor_string[stage_id] = f'{0:.4f}'
-						self.points_string[stage_id] = f'{0}'
-					else:
-						hit_factor_ratio = score.hit_factor/max_hit_factor
-						self.stage_percent[stage_id] = hit_factor_ratio*100
-						self.stage_percent_string[stage_id] = f'{hit_factor_ratio*100:.2f} %'
-						match_points = hit_factor_ratio*stage.max_points
-						self.match_points[stage_id] = match_points
-						self.match_points_string[stage_id] = f'{match_points:.4f}'
-						self.time_string[stage_id] = f'{score.time:.2f}'
-						self.hit_factor_string[stage_id] = f'{score.hit_factor:.4f}'
-						self.points_string[stage_id] = f'{score.points}'
-				else:
-					self.stage_percent[stage_id] = 0
-					self.stage_percent_string[stage_id] = '-'
-					self.match_points[stage_id] = 0
-					self.match_points_string[stage_id] = '-'
-					self.time_string[stage_id] = '-'
-					self.hit_factor_string[stage_id] = '-'
-					self.points_string[stage_id] = '-'
-					self.hits[stage_id] = {'A':'-', 'B':'-', 'C': '-', 'D': '-', 'M': '-', 'NS': '-', 'NPM': '-', 'Proc': '-'}
-		self.match_points_total = sum(self.match_points[x] for x in self.match_points)
-		self.match_points_total_string = f'{self.match_points_total:.4f}'
+			for stage_id in stage_ids:
+				if stage_id in self.match.stages and not self.match.stages[stage_id].deleted:
+					self.score_stage(stage_id, results.get(stage_id) if results else None)
+		self.match_points_total = sum(result[2] for result in self.results.values())
+	def rank_key(self):
+		return -self.match_points_total
+	def percent(self, leader):
+		return self.match_points_total/leader.match_points_total*100 if leader.match_points_total else 0
+	def score_stage(self, stage_id, result=None):
+		stage = self.match.stages[stage_id]
+		max_hit_factor = stage.max_hit_factors.get(self.division,0)
+		score = self.match.scores.get(stage_id, {}).get(self.id)
+		if not score:
+			self.results[stage_id] = ('missing', 0, 0)
+		elif score.dnf:
+			self.results[stage_id] = ('dnf', 0, 0)
+		elif score.time == 0:
+			self.results[stage_id] = ('untimed', 0, 0)
+		elif score.hit_factor == 0 or max_hit_factor == 0:
+			self.results[stage_id] = ('zero', 0, 0)
+		elif result:
+			self.results[stage_id] = ('scored',) + result
+		else:
+			hit_factor_ratio = score.hit_factor/max_hit_factor
+			self.results[stage_id] = ('scored', hit_factor_ratio*100, hit_factor_ratio*stage.max_points)
+	def stage_strings(self, state, stage_percent, match_points, score):
+		# stage_percent, match_points, time, hit_factor and points strings
+		if state == 'dnf':
+			return ('DNF',)*5
+		if state == 'zero':
+			return (f'{0:.2f} %', f'{0:.4f}', f'{0:.2f}', f'{0:.4f}', f'{0}')
+		if state == 'scored':
+			return (f'{stage_percent:.2f} %', f'{match_points:.4f}', f'{score.time:.2f}', f'{score.hit_factor:.4f}', f'{score.points}')
+		return ('-',)*5
 	def data(self):
-		self.scores()
-		return super().data() | {'hits': self.hits,
-			'hit_factor_string': self.hit_factor_string,
-			'match_points': self.match_points,
-			'match_points_string': self.match_points_string,
+		hits, penalties, stage_percent, match_points = {}, {}, {}, {}
+		strings = ({}, {}, {}, {}, {})
+		for stage_id, (state, percent, points) in self.results.items():
+			score = self.match.scores.get(stage_id, {}).get(self.id)
+			if state == 'missing':
+				hits[stage_id] = self.MISSING_HITS
+			else:
+				hits[stage_id] = score.hit_counts()
+				penalties[stage_id] = score.penalties
+			stage_percent[stage_id] = percent
+			match_points[stage_id] = points
+			for values, string in zip(strings, self.stage_strings(state, percent, points, score)):
+				values[stage_id] = string
+		return super().data() | {'hits': hits,
+			'hit_factor_string': strings[3],
+			'match_points': match_points,
+			'match_points_string': strings[1],
 			'match_points_total': self.match_points_total,
-			'match_points_total_string': self.match_points_total_string,
-			'points_string':self.points_string,
-			'time_string':self.time_string,
-			'stage_percent':self.stage_percent,
-			'stage_percent_string':self.stage_percent_string,
-			'penalties':self.penalties}
+			'match_points_total_string': f'{self.match_points_total:.4f}',
+			'points_string': strings[4],
+			'time_string': strings[2],
+			'stage_percent': stage_percent,
+			'stage_percent_string': strings[0],
+			'penalties': penalties}
 
 @Shooter.register('scsa')
 class SCSAShooter(Shooter):
-	def data(self):
-		return super().data() | {'scores': self.scores, 'time': self.time, 'scores_string': self.scores_string, 'time_string': self.time_string}
+	# a stage without a score counts as its maximum time and shows as '-'
+	__slots__ = ('scores', 'missing', 'time')
 
-	def post_process(self):
-		stage_list = self.match.stage_list
+	def data(self):
+		scores_string = {stage_id: '-' if stage_id in self.missing else f'{self.scores[stage_id]:.2f}' for stage_id in self.scores}
+		time_string = '-' if len(self.missing) == len(self.scores) else f'{self.time:.2f}'
+		return super().data() | {'scores': self.scores, 'time': self.time, 'scores_string': scores_string, 'time_string': time_string}
+
+	def post_process(self, stage_ids=None, results=None):
+		if stage_ids is None:
+			self.scores = dict.fromkeys(self.match.stage_list)
+			self.missing = set()
+			stage_ids = self.scores
 		scores = self.match.scores
-		self.scores = {stage_id: scores[stage_id][self.id].score if stage_id in scores and self.id in scores[stage_id] else 120 for stage_id in stage_list}
-		self.scores_string = {stage_id: '-' if self.scores[stage_id] == 120 else f'{self.scores[stage_id]:.2f}' for stage_id in self.scores}
-		self.time = sum(self.scores[stage_id] for stage_id in self.scores)
-		self.time_string = '-' if self.time == 480 else f'{self.time:.2f}'
+		for stage_id in stage_ids:
+			if stage_id not in self.scores:
+				continue
+			if stage_id in scores and self.id in scores[stage_id]:
+				self.scores[stage_id] = scores[stage_id][self.id].score
+				self.missing.discard(stage_id)
+			else:
+				self.scores[stage_id] = SCSAStage.MAX_TIME
+				self.missing.add(stage_id)
+		self.time = sum(self.scores.values())
+
+	def rank_key(self):
+		return self.time
+
+	def percent(self, leader):
+		return leader.time/self.time*100 if self.time else 0
 
 class Stage:
 	_subclasses = {}
@@ -589,10 +2061,12 @@ class Stage:
 		self.number = match_stage.get('stage_number')
 		self.update(match_stage)
 
-	def update_if_modified(self, match_stage):
+	def update_if_modified(self, match_stage, force=False):
 		modified_date = match_stage.get('stage_modifieddate')
-		if is_modified(modified_date, self.modified_date):
+		if force or is_modified(modified_date, self):
 			self.update(match_stage)
+			return True
+		return False
 
 	def update(self, match_stage):
 		self.number = match_stage.get('stage_number')
@@ -602,10 +2076,11 @@ class Stage:
 		else:
 			self.short_name = self.name
 		self.modified_date = match_stage.get('stage_modifieddate')
+		self.modified_stamp = date_stamp(self.modified_date)
 		self.deleted = match_stage.get('stage_deleted', False)
 
-	def post_process(self):
-		pass
+	def post_process(self, division):
+		return False
 
 	def data(self):
 		return {'id': self.id, 'number': self.number, 'name': self.name, 'short_name': self.short_name, 'stage_id': self.id}
@@ -624,28 +2099,29 @@ class IPSCStage(Stage):
 		self.stage_reqshots = self.stage_poppers + sum(stage_target.get('target_reqshots', 0) for stage_target in self.stage_targets)
 		self.max_points = 5*self.stage_reqshots
 	
-	def post_process(self):
-		self.max_hit_factor = 0
-		self.max_hit_factors = {}
-		for shooter_id in self.match.shooters:
-			if not self.match.shooters[shooter_id].deleted and not self.match.shooters[shooter_id].disqualified:
-				if self.id in self.match.scores and shooter_id in self.match.scores[self.id]:
-					hit_factor = self.match.scores[self.id][shooter_id].hit_factor
-					if shooter_id in self.match.shooters:
-						division = self.match.shooters[shooter_id].division
-						self.max_hit_factors[division] = max(self.max_hit_factors[division] if division in self.max_hit_factors else 0, hit_factor)
-					self.max_hit_factor = max(self.max_hit_factor, hit_factor)
-				
+	def post_process(self, division):
+		previous = self.max_hit_factors.get(division)
+		self.max_hit_factors.pop(division, None)
+		scores = self.match.scores.get(self.id, {})
+		for shooter_id in self.match.shooter_list_by_division.get(division, []):
+			if shooter_id in scores:
+				self.max_hit_factors[division] = max(self.max_hit_factors.get(division, 0), scores[shooter_id].hit_factor)
+		self.max_hit_factor = max(self.max_hit_factors.values(), default=0)
+		return self.max_hit_factors.get(division) != previous
 	
 	def data(self):
 		return super().data() | {'max_points': self.max_points, 'stage_reqshots': self.stage_reqshots, 'stage_poppers': self.stage_poppers, 'stage_targets': self.stage_targets, 'stage_deleted': self.deleted, 'max_hit_factor': self.max_hit_factor, 'max_hit_factors': self.max_hit_factors}
 
 @Stage.register('scsa')
 class SCSAStage(Stage):
-	pass
+	# five strings with the slowest dropped, each capped at 30 seconds
+	STRINGS = 5
+	MAX_STRING = 30
+	MAX_TIME = MAX_STRING*(STRINGS-1)
 
 class StageScore:
 	_subclasses = {}
+	__slots__ = ('match', 'stage_id', 'shooter_id', 'dnf', 'modified_date', 'modified_stamp')
 
 	@classmethod
 	def register(cls, sub_type):
@@ -670,11 +2146,14 @@ class StageScore:
 	def update(self, stage_stagescore):
 		self.dnf = stage_stagescore.get('dnf', False)
 		self.modified_date = stage_stagescore.get('mod')
+		self.modified_stamp = date_stamp(self.modified_date)
 
-	def update_if_modified(self, stage_stagescore):
+	def update_if_modified(self, stage_stagescore, force=False):
 		modified_date = stage_stagescore.get('mod')
-		if is_modified(modified_date, self.modified_date):
+		if force or is_modified(modified_date, self):
 			self.update(stage_stagescore)
+			return True
+		return False
 
 	def post_process(self):
 		pass
@@ -684,41 +2163,62 @@ class StageScore:
 
 @StageScore.register('ipsc')
 class IPSCStageScore(StageScore):
+	# hit counts are packed in HITS order
+	__slots__ = ('raw_points', 'poppers', 'procedurals', 'ts', 'time', 'hits', 'points', 'penalties', 'hit_factor')
+	HITS = ('A', 'B', 'C', 'D', 'M', 'NS', 'NPM', 'Proc')
+	HIT_INDEX = {k: i for i, k in enumerate(HITS)}
+
 	def update(self, stage_stagescore):
 		super().update(stage_stagescore)
 		self.raw_points = stage_stagescore.get('rawpts', 0)
-		hits = {'A':0, 'B':0, 'C': 0, 'D': 0, 'M': 0, 'NS': 0, 'NPM': 0, 'Proc': 0}
-		points = ('A', 'B', 'C', 'D')
-		penalties = ('M', 'NS')
-		pf = self.match.match_pfs.get(self.match.shooters[self.shooter_id].pf.lower(),{})
 		proc_cnts = stage_stagescore.get('proc_cnts',[])
-		hits['A'] = stage_stagescore.get('poph', 0)
-		hits['NS'] = stage_stagescore.get('popns', 0)
-		hits['M'] = stage_stagescore.get('popm', 0)
-		hits['Proc'] = sum(sum(proc_cnt[x] for x in proc_cnt) for proc_cnt in proc_cnts)
-		if 'ts' in stage_stagescore:
-			for x in stage_stagescore['ts']:
-				hits['A'] += (x) & 0xf
-				hits['B'] += (x >> 4) & 0xf
-				hits['C'] += (x >> 8) & 0xf
-				hits['D'] += (x >> 12) & 0xf
-				hits['NS'] += (x >> 16) & 0xf
-				hits['M'] += (x >> 20) & 0xf
-				hits['NPM'] += (x >> 24) & 0xf
-		self.points = sum(pf[k]*hits[k] for k in pf if k in points)
-		self.penalties = sum(pf[k]*hits[k] for k in pf if k in penalties)+10*hits['Proc']
+		self.poppers = (stage_stagescore.get('poph', 0), stage_stagescore.get('popns', 0), stage_stagescore.get('popm', 0))
+		self.procedurals = sum(sum(proc_cnt[x] for x in proc_cnt) for proc_cnt in proc_cnts)
+		self.ts = array.array('L', stage_stagescore.get('ts', []))
 		self.time = sum(stage_stagescore['str'])
-		self.time_string = f'{self.time:.2f}'
-		self.hits = hits
+
+	def decode_hits(self):
+		a, ns, m = self.poppers
+		hits = [a, 0, 0, 0, m, ns, 0, self.procedurals]
+		for x in self.ts:
+			hits[0] += (x) & 0xf
+			hits[1] += (x >> 4) & 0xf
+			hits[2] += (x >> 8) & 0xf
+			hits[3] += (x >> 12) & 0xf
+			hits[5] += (x >> 16) & 0xf
+			hits[4] += (x >> 20) & 0xf
+			hits[6] += (x >> 24) & 0xf
+		return array.array('I', hits)
+
+	def hit_counts(self):
+		return dict(zip(self.HITS, self.hits))
+
+	def pf(self):
+		return self.match.match_pfs.get(self.match.shooters[self.shooter_id].pf.lower(),{})
+
+	def post_process(self):
+		points = ('A', 'B', 'C', 'D')
+		penalties = ('M', 'NS')
+		self.hits = hits = self.decode_hits()
+		index = self.HIT_INDEX
+		pf = self.pf()
+		self.points = sum(pf[k]*hits[index[k]] for k in pf if k in points)
+		self.penalties = sum(pf[k]*hits[index[k]] for k in pf if k in penalties)+10*hits[index['Proc']]
 		if self.time == 0:
 			self.hit_factor = 0
-			self.hit_factor_string = '-'
 		else:
 			self.hit_factor = max(self.points-self.penalties, 0)/self.time
-			self.hit_factor_string = f'{self.hit_factor:.4f}'
+
+	def data(self):
+		return super().data() | {'hits': self.hit_counts(), 'points': self.points, 'penalties': self.penalties, 'time': self.time, 'hit_factor': self.hit_factor}
 
 @StageScore.register('scsa')
 class SCSAStageScore(StageScore):
+	# the stage time only depends on the score itself, so it is worked out
+	# once after each change rather than on every pass over the match
+	__slots__ = ('score', 'time', 'strings', 'penalties', 'strings_with_penalties')
+	PENALTIES = (3, 3, 30, 4)
+
 	def __init__(self, match, stage_id, stage_stagescore):
 		super().__init__(match, stage_id, stage_stagescore)
 		self.score = 0
@@ -727,73 +2227,282 @@ class SCSAStageScore(StageScore):
 		super().update(stage_stagescore)
 		self.strings = stage_stagescore.get('str', [0,0,0,0,0])
 		self.penalties = stage_stagescore.get('penss', [[0,0,0,0],[0,0,0,0],[0,0,0,0],[0,0,0,0],[0,0,0,0]])
+		self.time = None
 
 	def post_process(self):
-		penalties = [3, 3, 30, 4]
-		self.strings_with_penalties = [st+sum([p*q for p,q in zip(pen,penalties)]) for st,pen in zip(self.strings, self.penalties)]
-		self.strings_with_penalties = [ 30 if string == 0 else min(string,30) for string in self.strings_with_penalties]
+		if self.time is None:
+			self.strings_with_penalties = [st+sum([p*q for p,q in zip(pen,self.PENALTIES)]) for st,pen in zip(self.strings, self.penalties)]
+			self.strings_with_penalties = [SCSAStage.MAX_STRING if string == 0 else min(string,SCSAStage.MAX_STRING) for string in self.strings_with_penalties]
+			self.time = sum(self.strings_with_penalties) - max(self.strings_with_penalties, default=0)
 		if self.stage_id in self.match.stages:
-			self.score = sum(self.strings_with_penalties) - max(self.strings_with_penalties)
+			self.score = self.time
 		else:
-			self.score = 120
+			self.score = SCSAStage.MAX_TIME
 	def data(self):
 		return super().data() | {'score': self.score, 'strings': self.strings, 'penalties':self.penalties, 'strings_with_penalties':self.strings_with_penalties}
 
 class Kiosk:
-	def __init__(self):
+	DEFAULT_STATE_FILE = 'config/state.pickle'
+	DEFAULT_JOURNAL_DIR = 'config/journal'
+	DEFAULT_TEMPLATE_CACHE = '.cache/templates'
+	STATE_DELAY = 5
+	# the pickled model is only read back by the exact code that wrote it
+	with open(__file__, 'rb') as f:
+		STATE_FORMAT = hashlib.sha256(f.read()).hexdigest()[:16]
+
+	def __init__(self, registry=None):
 		self.filename = 'config/startup.json'
 		self.config = Config(self.filename)
+		self.state_file = self.config.data.get('state_file', self.DEFAULT_STATE_FILE)
+		self.template_cache = self.config.get('template_cache') or self.DEFAULT_TEMPLATE_CACHE
+		journal_dir = self.config.data.get('journal_dir', self.DEFAULT_JOURNAL_DIR)
+		self.journal = Journal(journal_dir) if journal_dir else None
 		devices = self.config.get('devices')
 		self.devices = {}
 		self.stage_name_substitutions = []
 		self.division_name_substitutions = self.config.get('division_name_substitutions',{})
+		self.kiosks = self.config.get('kiosks') or {}
+		profiler.directory = self.config.get('profile_dir') or Profiler.DEFAULT_DIRECTORY
+		self.registry = registry or MatchRegistry()
+		self.render_cache = RenderCache()
+		self.writer = Writer()
+		self.poller = None
 		for device in devices:
 			self.devices[device.get('id')] = Device.create(device)
-		for device in self.devices:
-			self.devices[device].update()
+			self.devices[device.get('id')].registry = self.registry
+			self.devices[device.get('id')].writer = self.writer
 
 	def data(self):
-		matches = self.matches()
-		return {'matches': [matches[id].data() for id in matches], 'devices': [self.devices[id].data() for id in self.devices]}
-
-	def matches(self):
-		matches = {}
-		for device_name in self.devices:
-			match_def = self.devices[device_name].match_def
-			match_scores = self.devices[device_name].match_scores
-			match_subtype = match_def.get('match_subtype', '')
-			match_id = match_def.get('match_id', '')
-			if match_id in matches:
-				matches[match_id].update(match_def, match_scores)
-			else:
-				match = Match.create(match_def, match_scores)
-				if match:
-					matches[match_id] = match
-		return matches
+		return {'matches': self.registry.data(), 'devices': self.device_data()}
+
+	def device_data(self):
+		return [self.devices[id].data() for id in self.devices]
+
+	def device_payload(self, id):
+		return self.devices[id].data() | { 'match_def': self.devices[id].match_def, 'match_scores': self.devices[id].match_scores }
+
+	def save_device(self, id):
+		self.devices[id].save()
+		return {'match_def': self.devices[id].match_def, 'match_scores': self.devices[id].match_scores}
 
 	def match(self, match_id):
-		matches = self.matches()
-		return matches.get(match_id)
+		return self.registry.match(match_id)
+
+	def metrics(self):
+		return metrics.render()
+
+	def profile(self, target, count):
+		profiler.arm(target, count)
+
+	def profiling(self):
+		return dict(profiler.armed)
 
 	def update(self):
 		for device in self.devices:
-			self.devices[device].update()
+			if self.poller:
+				self.poller.update(self.devices[device])
+			else:
+				self.devices[device].update()
 			self.devices[device].save()
 
 	def start(self):
-		self.scheduler = BackgroundScheduler()
-		for device_name in self.devices:
-			device = self.devices[device_name]
-			try:
-				if device.poll_time != 0:
-					self.scheduler.add_job(device.start, 'interval', seconds=device.poll_time)
-				else:
-					asyncio.run(device.start())
-			except Exception:
-				pass
-		self.scheduler.start()
+		# serve the last saved state at once and bring it up to date in the background
+		if self.state_file and self.load_state():
+			if self.journal and not self.journal.numbers('log'):
+				self.journal.seed([(id, device.match_def, device.match_scores) for id, device in self.devices.items() if device.match_def])
+		elif self.journal:
+			self.load_journal()
+		if self.state_file:
+			threading.Thread(target=self.save_state, name='state', daemon=True).start()
+		self.registry.journal = self.journal
+		self.poller = Poller(list(self.devices.values()), self.config.get('poller') or {})
+		self.poller.start()
+		threading.Thread(target=self.refresh, name='refresh', daemon=True).start()
+
+	def refresh(self):
+		# the poller skips devices without a poll_time; they are read once
+		for device in self.devices.values():
+			if not device.poll_time:
+				try:
+					device.update()
+					device.save()
+				except Exception as e:
+					print(f'{device.id}: {e!r}')
+
+	def state(self):
+		# devices before the registry: a digest is only set once its payload is merged
+		devices = pickle.dumps({id: self.devices[id].state() for id in self.devices}, pickle.HIGHEST_PROTOCOL)
+		registry = self.registry.state()
+		if registry is None:
+			# merges kept landing while it was pickled; try again after the delay
+			self.state_writer.write(self.state_file, self.state)
+			return None
+		return zlib.compress(pickle.dumps({'format': self.STATE_FORMAT, 'devices': devices, 'registry': registry}, pickle.HIGHEST_PROTOCOL), 1)
+
+	def load_state(self):
+		start = time.perf_counter()
+		try:
+			with open(self.state_file, 'rb') as f:
+				state = pickle.loads(zlib.decompress(f.read()))
+			if state.get('format') != self.STATE_FORMAT:
+				print(f'{self.state_file}: saved by another build, starting cold')
+				return False
+			devices = pickle.loads(state['devices'])
+			self.registry.restore(pickle.loads(state['registry']))
+		except FileNotFoundError:
+			return False
+		except Exception as e:
+			print(f'{self.state_file}: {e!r}, starting cold')
+			return False
+		for id in devices:
+			if id in self.devices:
+				self.devices[id].restore(devices[id])
+		print(f'{self.state_file}: restored version {self.registry.version} with {len(self.registry.matches)} matches in {(time.perf_counter() - start)*1000:.0f} ms')
+		return True
+
+	def load_journal(self):
+		# plain entity dicts outlive a state file from another version
+		start = time.perf_counter()
+		self.journal.replay(self.registry)
+		if self.registry.matches:
+			print(f'{self.journal.directory}: replayed {len(self.registry.matches)} matches in {(time.perf_counter() - start)*1000:.0f} ms')
+
+	def history(self, at):
+		if not self.journal:
+			return None
+		return self.journal.replay(MatchRegistry(), at)
+
+	def save_state(self):
+		self.state_writer = Writer(self.STATE_DELAY)
+		version = self.registry.version
+		while True:
+			if self.registry.wait(version, None):
+				version = self.registry.version
+				self.state_writer.write(self.state_file, self.state)
+
+class WebKiosk(Kiosk):
+	# a production web worker: devices are polled by the parent process and
+	# everything else is read from, or forwarded to, its snapshot publisher
+	def __init__(self, registry):
+		super().__init__(registry)
+		# so a device can never merge into the read-only snapshot
+		for device in self.devices.values():
+			device.registry = None
+
+	def device_data(self):
+		return self.registry.call('devices')
+
+	def device_payload(self, id):
+		return self.registry.call('device', id)
+
+	def save_device(self, id):
+		return self.registry.call('save', id)
+
+	def update(self):
+		return self.registry.call('update')
+
+	def metrics(self):
+		# polling and scoring happen in the parent; rendering in this worker
+		return self.registry.call('metrics') + metrics.render((('worker', os.getpid()),))
+
+	def profile(self, target, count):
+		# polls run in the parent; renders are profiled in this worker only
+		if target == 'poll':
+			self.registry.call('profile', target, count)
+		else:
+			super().profile(target, count)
+
+	def profiling(self):
+		return self.registry.call('profiling') | super().profiling()
+
+	def start(self):
+		pass
+
+class Server:
+	# the "server" section of config/startup.json: workers (one per CPU by
+	# default), host, port and socket. Workers serve with werkzeug's threaded
+	# server, which has no request timeouts or limits on slow clients; keep it
+	# on the range network or behind a reverse proxy
+	DEFAULT_HOST = '0.0.0.0'
+	DEFAULT_PORT = 5000
+	DEFAULT_SOCKET = os.path.join(tempfile.gettempdir(), 'practiscore-leaderboard.sock')
+	RESTART_DELAY = 1
+	MAX_RESTART_DELAY = 60
+	STABLE_TIME = 30
+
+	def __init__(self, kiosk, config):
+		self.kiosk = kiosk
+		self.workers = config.get('workers', os.cpu_count())
+		self.host = config.get('host', self.DEFAULT_HOST)
+		self.port = config.get('port', self.DEFAULT_PORT)
+		self.address = config.get('socket', self.DEFAULT_SOCKET)
+		self.authkey = os.urandom(32)
+		self.context = multiprocessing.get_context('spawn')
+
+	def start_worker(self):
+		worker = self.context.Process(target=serve_worker, args=(self.host, self.port, self.address, self.authkey), daemon=True)
+		worker.start()
+		return worker
+
+	def serve_forever(self):
+		# exit normally on SIGTERM so multiprocessing terminates the workers
+		signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit())
+		SnapshotPublisher(self.kiosk, self.address, self.authkey).start()
+		self.kiosk.start()
+		startup.mark('start')
+		workers = [self.start_worker() for _ in range(self.workers)]
+		startup.mark('workers')
+		startup.report()
+		started = [time.monotonic()]*len(workers)
+		failures = [0]*len(workers)
+		restarts = {}
+		while True:
+			timeout = max(min(restarts.values()) - time.monotonic(), 0) if restarts else None
+			multiprocessing.connection.wait([worker.sentinel for i, worker in enumerate(workers) if i not in restarts], timeout)
+			now = time.monotonic()
+			for i, worker in enumerate(workers):
+				if i in restarts:
+					if restarts[i] <= now:
+						del restarts[i]
+						workers[i] = self.start_worker()
+						started[i] = now
+				elif not worker.is_alive():
+					# a worker that keeps dying soon after it starts, say on a port
+					# taken by another process, is restarted with a growing delay
+					failures[i] = failures[i] + 1 if now - started[i] < self.STABLE_TIME else 0
+					delay = min(self.RESTART_DELAY * 2**(failures[i] - 1), self.MAX_RESTART_DELAY) if failures[i] else 0
+					print(f'worker {worker.pid}: exited with {worker.exitcode}' + (f', restarting in {delay} s' if delay else ''))
+					restarts[i] = now + delay
+
+def serve_worker(host, port, address, authkey):
+	global kiosk
+	import werkzeug.serving
+	kiosk = WebKiosk(SnapshotRegistry(address, authkey))
+	startup.mark('kiosk')
+	threading.Thread(target=precompile_templates, args=(kiosk.template_cache,), name='templates', daemon=True).start()
+	sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+	sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+	sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+	sock.bind((host, port))
+	sock.listen(128)
+	server = werkzeug.serving.make_server(host, port, app, threaded=True, fd=sock.fileno())
+	startup.mark('listen')
+	startup.report(f'worker {os.getpid()}')
+	server.serve_forever()
+
+startup.mark('module')
 
 if __name__ == '__main__':
 	kiosk = Kiosk()
-	kiosk.start()
-	app.run(host='0.0.0.0', debug=True)
+	startup.mark('kiosk')
+	threading.Thread(target=print_interfaces, name='interfaces', daemon=True).start()
+	server = kiosk.config.get('server')
+	if server and server.get('workers') != 0:
+		Server(kiosk, server).serve_forever()
+	else:
+		threading.Thread(target=precompile_templates, args=(kiosk.template_cache,), name='templates', daemon=True).start()
+		kiosk.start()
+		startup.mark('start')
+		startup.report()
+		# the reloader would run all of the above a second time in a child process
+		app.run(host='0.0.0.0', debug=True, use_reloader=False)
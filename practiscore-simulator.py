@@ -0,0 +1,210 @@
+#!/usr/bin/env python3
+import argparse
+import asyncio
+import importlib.util
+import itertools
+import json
+import os
+import random
+import struct
+import threading
+import time
+import zlib
+
+def load_benchmark():
+	spec = importlib.util.spec_from_file_location('benchmark', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'practiscore-benchmark.py'))
+	benchmark = importlib.util.module_from_spec(spec)
+	spec.loader.exec_module(benchmark)
+	return benchmark
+
+def percentile(values, p):
+	if not values:
+		return 0
+	values = sorted(values)
+	return values[min(len(values)-1, int(len(values)*p/100))]
+
+class Tablet:
+	# one virtual PractiScore tablet serving the match request framing on a local port
+	SIGNATURE = 0x19113006
+	VERSION = 4
+	MSG_MATCH_REQUEST = 8
+	MSG_MATCH_RESPONSE = 9
+	stamps = itertools.count(1)
+
+	def __init__(self, id, port, match_def, match_scores, options, benchmark):
+		self.id = id
+		self.port = port
+		self.match_def = match_def
+		self.match_scores = match_scores
+		self.options = options
+		self.benchmark = benchmark
+		self.random = random.Random(port)
+		self.generation = 0
+		self.served_generation = 0
+		self.changes = []
+		self.requests = 0
+		self.connections = 0
+		self.writers = set()
+		self.active = 0
+		self.dropped = 0
+		self.bytes_sent = 0
+		self.match_def_raw = zlib.compress(json.dumps(match_def).encode('utf-8'))
+		self.compress_scores()
+
+	def compress_scores(self):
+		self.match_scores_raw = zlib.compress(json.dumps(self.match_scores).encode('utf-8'))
+
+	async def start(self):
+		self.server = await asyncio.start_server(self.handle, '127.0.0.1', self.port)
+		if self.options.change_rate:
+			asyncio.create_task(self.change())
+
+	async def handle(self, reader, writer):
+		self.connections += 1
+		self.writers.add(writer)
+		try:
+			while True:
+				header = await reader.readexactly(20)
+				self.active += 1
+				try:
+					if not await self.respond(header, writer):
+						return
+				finally:
+					self.active -= 1
+				if not self.options.keep_alive:
+					return
+		except (asyncio.IncompleteReadError, ConnectionError):
+			pass
+		finally:
+			self.writers.discard(writer)
+			writer.close()
+
+	def stop(self):
+		# closing idle kept-alive connections ends their handlers
+		self.server.close()
+		for writer in list(self.writers):
+			writer.close()
+
+	async def respond(self, header, writer):
+		(signature, length, type, flags, request_time) = struct.unpack('!IIIII', header)
+		if signature != self.SIGNATURE or type != self.MSG_MATCH_REQUEST:
+			return False
+		self.requests += 1
+		latency = self.options.latency + self.random.uniform(-self.options.jitter, self.options.jitter)
+		await asyncio.sleep(max(latency, 0)/1000)
+		if self.random.random() < self.options.drop_rate:
+			self.dropped += 1
+			return False
+		generation = self.generation
+		body = struct.pack('!I', len(self.match_def_raw)) + self.match_def_raw + self.match_scores_raw
+		writer.write(struct.pack('!IIIII', self.SIGNATURE, len(body), self.MSG_MATCH_RESPONSE, self.VERSION, int(time.time())) + body)
+		await writer.drain()
+		self.served_generation = max(self.served_generation, generation)
+		self.bytes_sent += 20 + len(body)
+		return True
+
+	async def change(self):
+		scores = [stage_stagescore for stage in self.match_scores['match_scores'] for stage_stagescore in stage['stage_stagescores']]
+		while scores:
+			await asyncio.sleep(self.random.expovariate(self.options.change_rate))
+			stage_stagescore = self.random.choice(scores)
+			stage_stagescore['mod'] = self.benchmark.stamp(36000 + next(self.stamps))
+			stage_stagescore['str'] = [round(self.random.uniform(2, 60), 2) for _ in stage_stagescore['str']]
+			self.compress_scores()
+			self.generation += 1
+			self.changes.append((self.generation, time.monotonic()))
+
+	def freshness(self, now):
+		# lag of every change the kiosk has now seen through a completed poll
+		seen = [now - changed for generation, changed in self.changes if generation <= self.served_generation]
+		self.changes = [(generation, changed) for generation, changed in self.changes if generation > self.served_generation]
+		return seen
+
+def tablet_payloads(match_def, match_scores, tablets):
+	# each tablet scores every stage for its own squads
+	shooter_ids = [shooter['sh_uid'] for shooter in match_def['match_shooters']]
+	squads = {id: i % tablets for i, id in enumerate(shooter_ids)}
+	return [{'match_id': match_scores['match_id'], 'match_scores': [{'stage_uuid': stage['stage_uuid'], 'stage_stagescores': [score for score in stage['stage_stagescores'] if squads.get(score['shtr']) == tablet]} for stage in match_scores['match_scores']]} for tablet in range(tablets)]
+
+def measure(leaderboard, tablets, options):
+	poll_times = []
+	results = {'ok': 0, 'failed': 0, 'stopped': False}
+	freshness = []
+	lock = threading.Lock()
+
+	class MeasuredPSDevice(leaderboard.PSDevice):
+		async def poll(self):
+			if results['stopped']:
+				return True
+			start = time.monotonic()
+			ok = await super().poll()
+			now = time.monotonic()
+			with lock:
+				results['ok' if ok else 'failed'] += 1
+				if ok:
+					poll_times.append(now - start)
+					freshness.extend(self.tablet.freshness(now))
+			return ok
+
+	devices = []
+	for tablet in tablets:
+		device = MeasuredPSDevice({'id': tablet.id, 'type': 'PSDevice', 'address': '127.0.0.1', 'port': tablet.port, 'poll_time': options.poll_time, 'timeout': options.timeout, 'keep_alive': options.keep_alive})
+		device.tablet = tablet
+		device.registry = leaderboard.kiosk.registry
+		devices.append(device)
+	poller = leaderboard.Poller(devices, {'max_in_flight': options.max_in_flight})
+	poller.start()
+	return poller, poll_times, results, freshness
+
+async def main(options):
+	benchmark = load_benchmark()
+	match_def, match_scores = benchmark.GENERATORS[options.sub_type](options.shooters, options.stages, options.targets)
+	tablets = [Tablet(f'Sim{i}', options.port + i, match_def, payload, options, benchmark) for i, payload in enumerate(tablet_payloads(match_def, match_scores, options.tablets))]
+	for tablet in tablets:
+		await tablet.start()
+	sizes = [len(tablet.match_def_raw) + len(tablet.match_scores_raw) for tablet in tablets]
+	print(f'{len(tablets)} tablets on 127.0.0.1:{options.port}-{options.port + len(tablets) - 1}, {sum(sizes)/len(sizes)/1024:.1f} KiB compressed per response')
+	if options.serve:
+		print(json.dumps({'devices': [{'id': tablet.id, 'type': 'PSDevice', 'address': '127.0.0.1', 'port': tablet.port, 'poll_time': options.poll_time} for tablet in tablets]}, indent=2))
+		await asyncio.Event().wait()
+	leaderboard = benchmark.load_leaderboard()
+	poller, poll_times, results, freshness = measure(leaderboard, tablets, options)
+	await asyncio.sleep(options.duration)
+	duration = options.duration
+	results['stopped'] = True
+	# let polls already in flight finish before the tablets go away
+	while any(tablet.active for tablet in tablets):
+		await asyncio.sleep(0.1)
+	for tablet in tablets:
+		tablet.stop()
+	while any(tablet.writers for tablet in tablets):
+		await asyncio.sleep(0.1)
+	print(f'polls       {results["ok"]} ok, {results["failed"]} failed, {results["ok"]/duration:.1f} polls/s')
+	print(f'requests    {sum(tablet.requests for tablet in tablets)} over {sum(tablet.connections for tablet in tablets)} connections, {sum(tablet.dropped for tablet in tablets)} dropped, {sum(tablet.bytes_sent for tablet in tablets)/duration/1024:.1f} KiB/s sent')
+	print(f'poll        p50 {percentile(poll_times, 50)*1000:.1f} ms  p95 {percentile(poll_times, 95)*1000:.1f} ms  p99 {percentile(poll_times, 99)*1000:.1f} ms  max {max(poll_times, default=0)*1000:.1f} ms')
+	print(f'freshness   p50 {percentile(freshness, 50):.2f} s  p95 {percentile(freshness, 95):.2f} s  max {max(freshness, default=0):.2f} s over {len(freshness)} changes')
+	print(f'registry    version {leaderboard.kiosk.registry.version}')
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='Serve virtual PractiScore tablets on localhost and measure the poller against them.')
+	parser.add_argument('--tablets', type=int, default=50)
+	parser.add_argument('--port', type=int, default=59700, help='port of the first tablet')
+	parser.add_argument('--sub-type', default='ipsc', choices=['ipsc', 'scsa'])
+	parser.add_argument('--shooters', type=int, default=300)
+	parser.add_argument('--stages', type=int, default=12)
+	parser.add_argument('--targets', type=int, default=8)
+	parser.add_argument('--latency', type=float, default=50, help='response latency in ms')
+	parser.add_argument('--jitter', type=float, default=25, help='latency jitter in ms')
+	parser.add_argument('--drop-rate', type=float, default=0.01, help='fraction of requests closed without a response')
+	parser.add_argument('--change-rate', type=float, default=0.2, help='score changes per second per tablet')
+	parser.add_argument('--poll-time', type=float, default=2)
+	parser.add_argument('--timeout', type=float, default=5)
+	parser.add_argument('--max-in-flight', type=int, default=8)
+	parser.add_argument('--duration', type=float, default=30, help='seconds to measure for')
+	parser.add_argument('--keep-alive', action='store_true', help='serve several requests per connection and let the poller reuse them')
+	parser.add_argument('--serve', action='store_true', help='only serve the tablets and print their device config')
+	options = parser.parse_args()
+	try:
+		asyncio.run(main(options))
+	except KeyboardInterrupt:
+		pass